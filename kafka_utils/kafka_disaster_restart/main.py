@@ -1,11 +1,17 @@
 import argparse
-import itertools
 import logging
-import math
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Only the standard library is imported at module level, so that --help does
+# not wait for paramiko, kazoo and kafka-python to be imported. kafka_utils
+# modules are imported where they are used.
+
+
+DEFAULT_STOP_COMMAND = "service kafka stop"
+DEFAULT_START_COMMAND = "service kafka start"
 
-from kafka_utils.util import config
 
 def parse_opts():
     parser = argparse.ArgumentParser(
@@ -80,10 +86,105 @@ def parse_opts():
         type=str,
         help=('SSH passowrd to use if needed'),
     )
+    parser.add_argument(
+        '--no-compress',
+        dest='compress',
+        action='store_false',
+        help=('Disable SSH compression, for LAN setups where CPU matters more than bandwidth'),
+    )
+    parser.add_argument(
+        '--require-pty',
+        action='store_true',
+        help=('Run the start and stop commands on a pty, for hosts with Defaults requiretty in sudoers'),
+    )
     return parser.parse_args()
 
+
+def execute_task_in_parallel(tasks, hosts):
+    """Execute all the tasks for every host concurrently, one thread per host.
+    Expected to raise a TaskFailedException() in case of failing to execute a task
+    on any of the hosts.
+
+    :param tasks: the tasks to execute
+    :type tasks: list
+    :param hosts: the hosts on which the tasks are executed
+    :type hosts: list of strings
+    """
+    from kafka_utils.kafka_rolling_restart.main import execute_task
+
+    if not tasks or not hosts:
+        return
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        # Consuming the results re-raises the first exception of a worker
+        list(executor.map(partial(execute_task, tasks), hosts))
+
+
+def execute_disaster_restart(
+    brokers,
+    verbose,
+    pre_stop_task,
+    post_stop_task,
+    start_command,
+    stop_command,
+    ssh_password=None,
+    compress=True,
+    require_pty=False,
+):
+    """Execute the restart on the specified brokers. The pre and post stop
+    tasks do not depend on each other and are executed on all the brokers
+    at the same time, while the brokers are stopped and started one by one.
+
+    :param brokers: the brokers that will be restarted
+    :type brokers: map of broker ids and host names
+    :param verbose: print commend execution information
+    :type verbose: bool
+    :param pre_stop_task: a list of tasks to execute before running stop
+    :type pre_stop_task: list
+    :param post_stop_task: a list of task to execute after running stop
+    :type post_stop_task: list
+    :param start_command: the start command for kafka
+    :type start_command: string
+    :param stop_command: the stop command for kafka
+    :type stop_command: string
+    :param ssh_password: The ssh password to use if needed
+    :type ssh_password: string
+    :param compress: compress the SSH traffic
+    :type compress: bool
+    :param require_pty: run the commands on a pty
+    :type require_pty: bool
+    """
+    from kafka_utils.kafka_rolling_restart.main import start_broker
+    from kafka_utils.kafka_rolling_restart.main import stop_broker
+    from kafka_utils.util.ssh import ssh
+
+    all_hosts = [b[1] for b in brokers]
+    execute_task_in_parallel(pre_stop_task, all_hosts)
+    for n, host in enumerate(all_hosts):
+        with ssh(host=host, forward_agent=True, sudoable=True, max_attempts=3, max_timeout=2,
+                 ssh_password=ssh_password, compress=compress, require_pty=require_pty) as connection:
+            print(f"Stopping {host} ({n + 1}/{len(all_hosts)})")
+            stop_broker(host, connection, stop_command, verbose)
+    execute_task_in_parallel(post_stop_task, all_hosts)
+    for n, host in enumerate(all_hosts):
+        # we open a new SSH connection in case the hostname has a new IP
+        with ssh(host=host, forward_agent=True, sudoable=True, max_attempts=3, max_timeout=2,
+                 ssh_password=ssh_password, pooled=False, compress=compress, require_pty=require_pty) as connection:
+            print(f"Starting {host} ({n + 1}/{len(all_hosts)})")
+            start_broker(host, connection, start_command, verbose)
+
+
 def run():
     opts = parse_opts()
+
+    from kafka_utils.kafka_rolling_restart.main import ask_confirmation
+    from kafka_utils.kafka_rolling_restart.main import filter_broker_list
+    from kafka_utils.kafka_rolling_restart.main import get_broker_list
+    from kafka_utils.kafka_rolling_restart.main import get_task_class
+    from kafka_utils.kafka_rolling_restart.main import print_brokers
+    from kafka_utils.kafka_rolling_restart.main import validate_broker_ids_subset
+    from kafka_utils.kafka_rolling_restart.task import TaskFailedException
+    from kafka_utils.util import config
+
     if opts.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -92,4 +193,31 @@ def run():
         opts.cluster_type,
         opts.cluster_name,
         opts.discovery_base_path,
-    )
\ No newline at end of file
+    )
+    brokers = get_broker_list(cluster_config)
+    if opts.broker_ids:
+        if not validate_broker_ids_subset([id for id, host in brokers], opts.broker_ids):
+            sys.exit(1)
+        brokers = filter_broker_list(brokers, opts.broker_ids)
+    pre_stop_tasks = []
+    post_stop_tasks = []
+    if opts.task:
+        pre_stop_tasks, post_stop_tasks = get_task_class(opts.task, opts.task_args)
+    print_brokers(cluster_config, brokers)
+    if opts.no_confirm or ask_confirmation():
+        print("Execute restart")
+        try:
+            execute_disaster_restart(
+                brokers,
+                opts.verbose,
+                pre_stop_tasks,
+                post_stop_tasks,
+                opts.start_command,
+                opts.stop_command,
+                opts.ssh_password,
+                opts.compress,
+                opts.require_pty,
+            )
+        except TaskFailedException:
+            print("ERROR: pre/post tasks failed, exiting")
+            sys.exit(1)
@@ -26,8 +26,6 @@ from .task import PostStopTask
 from .task import PreStopTask
 from .task import TaskFailedException
 from kafka_utils.util import config
-from kafka_utils.util.ssh import report_stderr
-from kafka_utils.util.ssh import report_stdout
 from kafka_utils.util.ssh import ssh
 from kafka_utils.util.utils import dynamic_import
 from kafka_utils.util.zookeeper import ZK
@@ -180,6 +178,17 @@ def parse_opts():
         type=str,
         help=('SSH passowrd to use if needed'),
     )
+    parser.add_argument(
+        '--no-compress',
+        dest='compress',
+        action='store_false',
+        help=('Disable SSH compression, for LAN setups where CPU matters more than bandwidth'),
+    )
+    parser.add_argument(
+        '--require-pty',
+        action='store_true',
+        help=('Run the start and stop commands on a pty, for hosts with Defaults requiretty in sudoers'),
+    )
     return parser.parse_args()
 
 
@@ -316,20 +325,26 @@ def ask_confirmation():
             print("Please respond with 'yes' or 'no'")
 
 
+def execute_sudo_command(host, connection, command, verbose):
+    """Execute a command with sudo, printing its output as it arrives if verbose.
+    The output is read while the command runs, so that it is not buffered whole
+    and a large output cannot stall the command.
+
+    :raises RuntimeError: if the command exits with a non-zero status
+    """
+    _, stdout, stderr = connection.sudo_command(command, check_status=False)
+    if connection.wait_for_command(host, stdout, stderr, report=verbose) != 0:
+        raise RuntimeError(f"Command execution error: {command}")
+
+
 def start_broker(host, connection, start_command, verbose):
     """Execute the start"""
-    _, stdout, stderr = connection.sudo_command(start_command)
-    if verbose:
-        report_stdout(host, stdout)
-        report_stderr(host, stderr)
+    execute_sudo_command(host, connection, start_command, verbose)
 
 
 def stop_broker(host, connection, stop_command, verbose):
     """Execute the stop"""
-    _, stdout, stderr = connection.sudo_command(stop_command)
-    if verbose:
-        report_stdout(host, stdout)
-        report_stderr(host, stderr)
+    execute_sudo_command(host, connection, stop_command, verbose)
 
 
 def wait_for_stable_cluster(
@@ -416,7 +431,9 @@ def execute_rolling_restart(
     post_stop_task,
     start_command,
     stop_command,
-    ssh_password=None
+    ssh_password=None,
+    compress=True,
+    require_pty=False,
 ):
     """Execute the rolling restart on the specified brokers. It checks the
     number of under replicated partitions on each broker, using Jolokia.
@@ -457,11 +474,15 @@ def execute_rolling_restart(
     :type stop_command: string
     :param ssh_password: The ssh password to use if needed
     :type ssh_password: string
+    :param compress: compress the SSH traffic
+    :type compress: bool
+    :param require_pty: run the commands on a pty
+    :type require_pty: bool
     """
     all_hosts = [b[1] for b in brokers]
     for n, host in enumerate(all_hosts[skip:]):
         with ssh(host=host, forward_agent=True, sudoable=True, max_attempts=3, max_timeout=2,
-                 ssh_password=ssh_password) as connection:
+                 ssh_password=ssh_password, compress=compress, require_pty=require_pty) as connection:
             execute_task(pre_stop_task, host)
             wait_for_stable_cluster(
                 all_hosts,
@@ -478,7 +499,7 @@ def execute_rolling_restart(
             execute_task(post_stop_task, host)
         # we open a new SSH connection in case the hostname has a new IP
         with ssh(host=host, forward_agent=True, sudoable=True, max_attempts=3, max_timeout=2,
-                 ssh_password=ssh_password) as connection:
+                 ssh_password=ssh_password, pooled=False, compress=compress, require_pty=require_pty) as connection:
             print(f"Starting {host} ({n + 1}/{len(all_hosts) - skip})")
             start_broker(host, connection, start_command, verbose)
     # Wait before terminating the script
@@ -609,7 +630,9 @@ def run():
                 post_stop_tasks,
                 opts.start_command,
                 opts.stop_command,
-                opts.ssh_password
+                opts.ssh_password,
+                opts.compress,
+                opts.require_pty,
             )
         except TaskFailedException:
             print("ERROR: pre/post tasks failed, exiting")
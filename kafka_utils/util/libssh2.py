@@ -0,0 +1,319 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SSH connections backed by libssh2, through the optional ssh2-python package.
+The per-command overhead of libssh2 is much lower than paramiko's, which
+matters when many short commands are executed.
+"""
+from __future__ import annotations
+
+import getpass
+import io
+import os
+import select
+import socket
+from typing import Any
+from typing import Callable
+from typing import Union
+
+from ssh2.exceptions import AuthenticationError
+from ssh2.exceptions import KeyfileAuthFailedError
+from ssh2.exceptions import SSH2Error
+from ssh2.session import LIBSSH2_FLAG_COMPRESS
+from ssh2.session import LIBSSH2_SESSION_BLOCK_OUTBOUND
+from ssh2.session import Session
+from ssh2.sftp import LIBSSH2_FXF_CREAT
+from ssh2.sftp import LIBSSH2_FXF_TRUNC
+from ssh2.sftp import LIBSSH2_FXF_WRITE
+from ssh2.sftp import LIBSSH2_SFTP_S_IRGRP
+from ssh2.sftp import LIBSSH2_SFTP_S_IROTH
+from ssh2.sftp import LIBSSH2_SFTP_S_IRUSR
+from ssh2.sftp import LIBSSH2_SFTP_S_IWUSR
+
+from kafka_utils.util.ssh import retry_connect
+from kafka_utils.util.ssh import stderr_reporter
+from kafka_utils.util.ssh import stdout_reporter
+
+
+CHUNK_SIZE = 32768
+
+# the keys paramiko also looks for, after the configured IdentityFile ones
+DEFAULT_KEY_FILES = ("~/.ssh/id_rsa", "~/.ssh/id_dsa", "~/.ssh/id_ecdsa", "~/.ssh/id_ed25519")
+
+
+class Ssh2ChannelFile:
+    """Read only file over the stdout, or the stderr, of a libssh2 channel.
+
+    :param channel: the channel executing the command
+    :type channel: ssh2.channel.Channel
+    :param stderr: read the stderr of the channel instead of its stdout
+    :type stderr: bool
+    """
+
+    def __init__(self, channel: Any, stderr: bool = False) -> None:
+        self.channel = channel
+        self._read: Callable[[int], tuple[int, bytes]] = channel.read_stderr if stderr else channel.read
+
+    def read(self, size: int = -1) -> bytes:
+        """Read at most size bytes, or until EOF if size is negative.
+        Returns b"" at EOF.
+        """
+        if size >= 0:
+            return self._read(size)[1]
+        return b"".join(iter(lambda: self._read(CHUNK_SIZE)[1], b""))
+
+    def readlines(self) -> list[bytes]:
+        return self.read().splitlines(keepends=True)
+
+
+class Ssh2ChannelStdin:
+    """Write only file over the stdin of a libssh2 channel.
+
+    :param channel: the channel executing the command
+    :type channel: ssh2.channel.Channel
+    """
+
+    def __init__(self, channel: Any) -> None:
+        self.channel = channel
+
+    def write(self, data: Union[str, bytes]) -> None:
+        self.channel.write(data.encode() if isinstance(data, str) else data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.channel.send_eof()
+
+
+ReadableFile = Union[io.BytesIO, Ssh2ChannelFile]
+
+
+class Ssh2Connection:
+    """Represents a SSH connection with an SSH server, backed by libssh2.
+    Offers the same commands as :class:`~ssh.Connection`.
+    """
+
+    def __init__(self, session: Any, sock: socket.socket, forward_agent: bool, sudoable: bool, require_pty: bool = False) -> None:
+        self.session = session
+        self.sock = sock
+        self.forward_agent = forward_agent
+        self.sudoable = sudoable
+        self.require_pty = require_pty
+
+    def close(self) -> None:
+        try:
+            self.session.disconnect()
+        finally:
+            self.sock.close()
+
+    def put_file(self, local_path: str, remote_path: str) -> None:
+        """Put a file on the SSH server.
+
+        :param local_path: the local path of the file to put
+        :type local_path: str
+        :param remote_path: the remote path to put the file
+        :type remote_path: str
+        """
+        sftp = self.session.sftp_init()
+        mode = LIBSSH2_SFTP_S_IRUSR | LIBSSH2_SFTP_S_IWUSR | LIBSSH2_SFTP_S_IRGRP | LIBSSH2_SFTP_S_IROTH
+        with open(local_path, 'rb') as local, sftp.open(remote_path, LIBSSH2_FXF_CREAT | LIBSSH2_FXF_WRITE | LIBSSH2_FXF_TRUNC, mode) as remote:
+            for chunk in iter(lambda: local.read(CHUNK_SIZE), b""):
+                remote.write(chunk)
+
+    def sudo_command(self, command: str, bufsize: int = -1, check_status: bool = True, passwd: str | None = None) -> tuple[Ssh2ChannelStdin, ReadableFile, ReadableFile]:
+        """Sudo a command on the SSH server.
+        Delegates to :func`~libssh2.Ssh2Connection.exec_command`
+        See :func:`~ssh.Connection.sudo_command`
+
+        :raises ValueError: if a password is given on a connection requiring a pty
+        """
+        if passwd is None:
+            return self.exec_command(f"sudo -n {command}", bufsize, check_status)
+        if self.require_pty:
+            # the pty would echo the password to stdout before sudo turns echo off
+            raise ValueError("The ssh2 backend cannot send a sudo password on a pty, use the paramiko backend")
+        # -k, so that the password is read even when the credentials are cached
+        return self.exec_command(f"sudo -k -S -p '' {command}", bufsize, check_status, stdin_data=f"{passwd}\n")
+
+    def exec_command(self, command: str, bufsize: int = -1, check_status: bool = True, stdin_data: str | None = None) -> tuple[Ssh2ChannelStdin, ReadableFile, ReadableFile]:
+        """Execute a command on the SSH server.
+        See :func:`~ssh.Connection.exec_command`, bufsize is ignored.
+
+        When check_status is enabled the whole output is read while waiting
+        for the command to complete, and returned as in memory files.
+
+        :raises RuntimeError: if check_status is enabled and the status is non-zero
+        """
+        channel = self.session.open_session()
+        if self.forward_agent:
+            channel.request_auth_agent()
+        if self.require_pty:
+            channel.pty()
+
+        channel.execute(command)
+        stdin = Ssh2ChannelStdin(channel)
+        if stdin_data is not None:
+            stdin.write(stdin_data)
+
+        stdout: ReadableFile = Ssh2ChannelFile(channel)
+        stderr: ReadableFile = Ssh2ChannelFile(channel, stderr=True)
+        if check_status:
+            out = bytearray()
+            err = bytearray()
+            self._read_output(channel, out.extend, err.extend)
+            stdout = io.BytesIO(bytes(out))
+            stderr = io.BytesIO(bytes(err))
+            if self._exit_status(channel) != 0:
+                raise RuntimeError(f"Command execution error: {command}")
+        return (stdin, stdout, stderr)
+
+    def _read_output(self, channel: Any, on_stdout: Callable[[bytes], Any], on_stderr: Callable[[bytes], Any]) -> None:
+        """Read the stdout and the stderr of a channel in turns, as they arrive,
+        until the command closes them. Reading one until EOF before the other
+        would stall the command once the unread one fills the channel window.
+
+        :param channel: the channel executing the command
+        :type channel: ssh2.channel.Channel
+        :param on_stdout: called with every chunk of stdout
+        :type on_stdout: callable
+        :param on_stderr: called with every chunk of stderr
+        :type on_stderr: callable
+        """
+        streams = ((channel.read, on_stdout), (channel.read_stderr, on_stderr))
+        self.session.set_blocking(False)
+        try:
+            while True:
+                progressed = False
+                for read, on_data in streams:
+                    size, data = read(CHUNK_SIZE)
+                    # EAGAIN when nothing arrived yet, 0 at EOF
+                    while size > 0:
+                        on_data(data)
+                        progressed = True
+                        size, data = read(CHUNK_SIZE)
+                # no EOF while data is still waiting to be read
+                if channel.eof():
+                    return
+                if not progressed:
+                    writable = [self.sock] if self.session.block_directions() & LIBSSH2_SESSION_BLOCK_OUTBOUND else []
+                    select.select([self.sock], writable, [])
+        finally:
+            self.session.set_blocking(True)
+
+    @staticmethod
+    def _exit_status(channel: Any) -> int:
+        channel.wait_eof()
+        channel.close()
+        channel.wait_closed()
+        return channel.get_exit_status()
+
+    def wait_for_command(self, host: str, stdout: ReadableFile, stderr: ReadableFile, report: bool = True) -> int:
+        """Wait for a command started with check_status disabled to complete.
+        See :func:`~ssh.Connection.wait_for_command`
+        """
+        out = stdout_reporter(host) if report else None
+        err = stderr_reporter(host) if report else None
+        if not isinstance(stdout, Ssh2ChannelFile):
+            # the in memory files of a command which already completed successfully
+            for remote, reporter in ((stdout, out), (stderr, err)):
+                if reporter is not None:
+                    reporter.feed(remote.read())
+                    reporter.close()
+            return 0
+        self._read_output(
+            stdout.channel,
+            out.feed if out is not None else _discard,
+            err.feed if err is not None else _discard,
+        )
+        for reporter in (out, err):
+            if reporter is not None:
+                reporter.close()
+        return self._exit_status(stdout.channel)
+
+    def exec_batch(self, commands: list[str], bufsize: int = -1, independent: bool = False, check_status: bool = True) -> tuple[Ssh2ChannelStdin, ReadableFile, ReadableFile]:
+        """Execute several commands on the SSH server with a single channel.
+        See :func:`~ssh.Connection.exec_batch`
+        """
+        separator = "; " if independent else " && "
+        return self.exec_command(separator.join(commands), bufsize, check_status)
+
+
+def _discard(data: bytes) -> None:
+    pass
+
+
+def _authenticate(session: Any, cfg: dict[str, Any]) -> None:
+    username = cfg.get("username") or getpass.getuser()
+    if cfg.get("password"):
+        session.userauth_password(username, cfg["password"])
+        return
+    key_filenames = [*(cfg.get("key_filename") or ()), *DEFAULT_KEY_FILES]
+    for key_filename in key_filenames:
+        key_filename = os.path.expanduser(key_filename)
+        if not os.path.exists(key_filename):
+            continue
+        try:
+            session.userauth_publickey_fromfile(username, key_filename)
+            return
+        except (AuthenticationError, KeyfileAuthFailedError):
+            # rejected or encrypted, try the next one like ssh does
+            continue
+    session.agent_auth(username)
+
+
+def connect(host: str, cfg: dict[str, Any], max_attempts: int, max_timeout: int, forward_agent: bool, sudoable: bool, require_pty: bool = False) -> Ssh2Connection:
+    """Establish a new libssh2 connection to the desired host.
+    ProxyCommand is not supported.
+
+    :param host: the server to connect to
+    :type host: str
+    :param cfg: the arguments :func:`~ssh.ssh` would pass to paramiko
+    :type cfg: dict
+    :param max_attempts: the maximum attempts to connect to the desired host
+    :type max_attempts: int
+    :param max_timeout: the maximum timeout in seconds to sleep between attempts
+    :type max_timeout: int
+    :param forward_agent: forward the local agents
+    :type forward_agent: bool
+    :param sudoable: allow sudo commands
+    :type sudoable: bool
+    :param require_pty: request a pty for every command
+    :type require_pty: bool
+    :rtype: Ssh2Connection
+
+    :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
+    to establish the SSH connection.
+    """
+    def attempt() -> Ssh2Connection:
+        sock = socket.create_connection((cfg["hostname"], cfg.get("port", 22)), cfg.get("timeout"))
+        try:
+            session = Session()
+            if cfg.get("compress"):
+                # negotiated during the handshake
+                session.flag(LIBSSH2_FLAG_COMPRESS)
+            session.handshake(sock)
+            _authenticate(session, cfg)
+        except (AuthenticationError, KeyfileAuthFailedError):
+            sock.close()
+            raise
+        except SSH2Error as e:
+            sock.close()
+            # not OSErrors, so that retry_connect would not retry them otherwise
+            raise ConnectionError(f"{type(e).__name__}: {e}") from e
+        except BaseException:
+            sock.close()
+            raise
+        return Ssh2Connection(session, sock, forward_agent, sudoable, require_pty)
+
+    return retry_connect(host, attempt, max_attempts, max_timeout)
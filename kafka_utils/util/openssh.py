@@ -0,0 +1,223 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SSH connections running the OpenSSH client. All the connections of the
+process to a host are multiplexed over one master connection (ControlMaster),
+so only the first one pays for the handshake and authentication.
+The user ssh config and agent are used as they are, passwords are not supported.
+"""
+from __future__ import annotations
+
+import atexit
+import functools
+import io
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+from typing import IO
+from typing import Union
+
+from kafka_utils.util.ssh import LineReporter
+from kafka_utils.util.ssh import REPORT_CHUNK_SIZE
+from kafka_utils.util.ssh import report_stderr
+from kafka_utils.util.ssh import report_stdout
+from kafka_utils.util.ssh import retry_connect
+from kafka_utils.util.ssh import stderr_reporter
+from kafka_utils.util.ssh import stdout_reporter
+
+
+CONTROL_PERSIST = "60s"
+
+# exit status of the ssh client when the connection itself failed
+SSH_CONNECTION_ERROR = 255
+
+
+@functools.lru_cache(maxsize=1)
+def control_dir() -> str:
+    """Return the private directory holding the control sockets of the process.
+    It is removed at exit, the master connections exit on their own after
+    CONTROL_PERSIST.
+    """
+    path = tempfile.mkdtemp(prefix="kafka-utils-ssh-")
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+
+def ssh_args(host: str, max_timeout: int, forward_agent: bool = False, require_pty: bool = False, compress: bool = False) -> list[str]:
+    """Return the ssh command line connecting to host through the shared master connection."""
+    args = [
+        "ssh",
+        "-o", "ControlMaster=auto",
+        # %C is a hash of the host, port and user, so that long host names do
+        # not exceed the unix socket path limit
+        "-o", f"ControlPath={os.path.join(control_dir(), 'ku-%C')}",
+        "-o", f"ControlPersist={CONTROL_PERSIST}",
+        "-o", "BatchMode=yes",
+        "-o", f"ConnectTimeout={max_timeout}",
+    ]
+    if forward_agent:
+        args.append("-A")
+    if require_pty:
+        args.append("-tt")
+    if compress:
+        # only the master connection compresses, the sessions share its transport
+        args.append("-C")
+    return args + [host]
+
+
+ReadableFile = Union[io.BytesIO, IO[bytes]]
+
+
+class OpenSSHConnection:
+    """Represents a SSH connection with an SSH server, through the OpenSSH client.
+    Offers the same commands as :class:`~ssh.Connection`.
+    """
+
+    def __init__(self, host: str, max_timeout: int, forward_agent: bool, sudoable: bool, require_pty: bool = False, compress: bool = False) -> None:
+        self.host = host
+        self.max_timeout = max_timeout
+        self.sudoable = sudoable
+        self.require_pty = require_pty
+        self.args = ssh_args(host, max_timeout, forward_agent, require_pty, compress)
+        # the processes of the commands started with check_status disabled, by stdout
+        self._processes: dict[IO[bytes], subprocess.Popen[bytes]] = {}
+
+    def close(self) -> None:
+        """The master connection is kept for CONTROL_PERSIST, for the next connections."""
+        pass
+
+    def put_file(self, local_path: str, remote_path: str) -> None:
+        """Put a file on the SSH server.
+
+        :param local_path: the local path of the file to put
+        :type local_path: str
+        :param remote_path: the remote path to put the file
+        :type remote_path: str
+        """
+        # scp takes the same options as ssh, minus the destination and the pty
+        options = [arg for arg in self.args[1:-1] if arg not in ("-A", "-tt")]
+        subprocess.run(["scp", *options, local_path, f"{self.host}:{remote_path}"], check=True)
+
+    def sudo_command(self, command: str, bufsize: int = -1, check_status: bool = True, passwd: str | None = None) -> tuple[IO[bytes], ReadableFile, ReadableFile]:
+        """Sudo a command on the SSH server.
+        Delegates to :func`~openssh.OpenSSHConnection.exec_command`
+        See :func:`~ssh.Connection.sudo_command`
+
+        :raises ValueError: if a password is given on a connection requiring a pty
+        """
+        if passwd is None:
+            return self.exec_command(f"sudo -n {command}", bufsize, check_status)
+        if self.require_pty:
+            # the pty would echo the password to stdout before sudo turns echo off
+            raise ValueError("The openssh backend cannot send a sudo password on a pty, use the paramiko backend")
+        # -k, so that the password is read even when the credentials are cached
+        return self.exec_command(f"sudo -k -S -p '' {command}", bufsize, check_status, stdin_data=f"{passwd}\n")
+
+    def exec_command(self, command: str, bufsize: int = -1, check_status: bool = True, stdin_data: str | None = None) -> tuple[IO[bytes], ReadableFile, ReadableFile]:
+        """Execute a command on the SSH server.
+        See :func:`~ssh.Connection.exec_command`
+
+        When check_status is enabled the whole output is read while waiting
+        for the command to complete, and returned as in memory files.
+
+        :raises RuntimeError: if check_status is enabled and the status is non-zero
+        """
+        process = subprocess.Popen(
+            self.args + [command],
+            bufsize=bufsize,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        assert process.stdin is not None and process.stdout is not None and process.stderr is not None
+        data = stdin_data.encode() if stdin_data is not None else None
+        if check_status:
+            stdout, stderr = process.communicate(data)
+            if process.returncode != 0:
+                raise RuntimeError(f"Command execution error: {command}")
+            return (process.stdin, io.BytesIO(stdout), io.BytesIO(stderr))
+
+        if data is not None:
+            process.stdin.write(data)
+            process.stdin.flush()
+        self._processes[process.stdout] = process
+        return (process.stdin, process.stdout, process.stderr)
+
+    def wait_for_command(self, host: str, stdout: ReadableFile, stderr: ReadableFile, report: bool = True) -> int:
+        """Wait for a command started with check_status disabled to complete.
+        See :func:`~ssh.Connection.wait_for_command`
+        """
+        process = self._processes.pop(stdout, None)
+        if process is None:
+            # the in memory files of a command which already completed successfully
+            if report:
+                report_stdout(host, stdout)
+                report_stderr(host, stderr)
+            return 0
+        reporters: dict[int, LineReporter | None] = {
+            stdout.fileno(): stdout_reporter(host) if report else None,
+            stderr.fileno(): stderr_reporter(host) if report else None,
+        }
+        pending = list(reporters)
+        while pending:
+            readable, _, _ = select.select(pending, [], [])
+            for fd in readable:
+                data = os.read(fd, REPORT_CHUNK_SIZE)
+                reporter = reporters[fd]
+                if not data:
+                    pending.remove(fd)
+                    if reporter is not None:
+                        reporter.close()
+                elif reporter is not None:
+                    reporter.feed(data)
+        return process.wait()
+
+    def exec_batch(self, commands: list[str], bufsize: int = -1, independent: bool = False, check_status: bool = True) -> tuple[IO[bytes], ReadableFile, ReadableFile]:
+        """Execute several commands on the SSH server with a single channel.
+        See :func:`~ssh.Connection.exec_batch`
+        """
+        separator = "; " if independent else " && "
+        return self.exec_command(separator.join(commands), bufsize, check_status)
+
+
+def connect(host: str, max_attempts: int, max_timeout: int, forward_agent: bool, sudoable: bool, require_pty: bool = False, compress: bool = False) -> OpenSSHConnection:
+    """Establish the master connection to the desired host, if not already there.
+
+    :param host: the server to connect to
+    :type host: str
+    :param max_attempts: the maximum attempts to connect to the desired host
+    :type max_attempts: int
+    :param max_timeout: the maximum timeout in seconds to sleep between attempts
+    :type max_timeout: int
+    :param forward_agent: forward the local agents
+    :type forward_agent: bool
+    :param sudoable: allow sudo commands
+    :type sudoable: bool
+    :param require_pty: request a pty for every command
+    :type require_pty: bool
+    :param compress: compress the SSH traffic, when the master connection is started
+    :type compress: bool
+    :rtype: OpenSSHConnection
+
+    :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
+    to establish the SSH connection.
+    """
+    def attempt() -> OpenSSHConnection:
+        result = subprocess.run(ssh_args(host, max_timeout, compress=compress) + ["true"], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode == SSH_CONNECTION_ERROR:
+            raise ConnectionError(result.stderr.decode(errors="replace").strip())
+        return OpenSSHConnection(host, max_timeout, forward_agent, sudoable, require_pty, compress)
+
+    return retry_connect(host, attempt, max_attempts, max_timeout)
@@ -13,49 +13,223 @@
 # limitations under the License.
 from __future__ import annotations
 
+import atexit
+import functools
+import io
 import os
+import queue
+import random
+import re
+import select
+import shlex
+import socket
 import sys
+import tarfile
+import threading
 import time
 from contextlib import closing
 from contextlib import contextmanager
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import IO
 from typing import Iterator
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import TypeVar
+from typing import Union
 
 from paramiko import ProxyCommand
 from paramiko import SSHConfig
 from paramiko.agent import AgentRequestHandler
+from paramiko.channel import Channel
 from paramiko.channel import ChannelFile
+from paramiko.channel import ChannelStderrFile
 from paramiko.client import AutoAddPolicy
 from paramiko.client import SSHClient
+from paramiko.sftp_client import SFTPClient
+from paramiko.ssh_exception import AuthenticationException
+from paramiko.ssh_exception import BadHostKeyException
+from paramiko.ssh_exception import SSHException
 
 from kafka_utils.util.error import MaxConnectionAttemptsError
 
+if TYPE_CHECKING:
+    from kafka_utils.util.libssh2 import Ssh2Connection
+    from kafka_utils.util.openssh import OpenSSHConnection
+
+
+T = TypeVar("T")
+
+# the stdout of a command, in memory when it was read while waiting for a password prompt
+StdoutFile = Union[ChannelFile, io.BytesIO]
+
+PoolKey = Tuple[str, Tuple[Tuple[str, Any], ...]]
+# connect options which only bound the handshake, a client is the same whatever their value
+POOL_KEY_IGNORED_OPTIONS = ("hostname", "timeout", "banner_timeout", "auth_timeout")
+
+RETRY_BACKOFF_SECS = 0.25
+
+SSH_BACKEND_ENV = "KAFKA_UTILS_SSH_BACKEND"
+SSH_BACKENDS = ("paramiko", "ssh2", "openssh")
+
+SHELL_RC_MARKER = b"__RC="
+SHELL_END_MARKER = b"__KU_END__"
+
+REPORT_CHUNK_SIZE = 8192
+
+# matched against the last, incomplete, line only: a prompt is not followed by a newline
+PASSWORD_PROMPT = re.compile(rb'[Pp]assword[^:\n]*: ?$')
+PASSWORD_PROMPT_TIMEOUT = 10
+
+
+def _send_password_on_prompt(channel: Channel, passwd: str, timeout: float = PASSWORD_PROMPT_TIMEOUT) -> bytes | None:
+    """Wait for the command to prompt for a password, then send it.
+    The prompt is consumed, so it is not part of the command output.
+
+    A command which does not prompt, e.g. sudo on a NOPASSWD rule, is waited
+    for instead, and the output read meanwhile returned.
+
+    :param channel: the channel executing the command
+    :type channel: paramiko.channel.Channel
+    :param passwd: the password to send
+    :type passwd: str
+    :param timeout: the maximum time in seconds to wait for the prompt, before
+    waiting for the command to complete
+    :type timeout: float
+    :returns None if the password was sent, otherwise the output of the completed command
+    :rtype: bytes
+
+    :raises SSHException: if the command fails without prompting for a password
+    """
+    received = b""
+    channel.settimeout(timeout)
+    try:
+        while not PASSWORD_PROMPT.search(received.rpartition(b"\n")[2]):
+            chunk = channel.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        else:
+            channel.send(passwd.encode() + b"\n")
+            return None
+    except socket.timeout:
+        # a quiet command, sudo prompts before anything else
+        pass
+    finally:
+        channel.settimeout(None)
+    received += b"".join(iter(functools.partial(channel.recv, 4096), b""))
+    if channel.recv_exit_status() != 0:
+        raise SSHException("Command failed without prompting for a password")
+    return received
+
+
+class PersistentShell:
+    """Runs several commands one after another in the same remote shell, so
+    that only the first command pays for opening a channel.
+
+    :param channel: a channel on which a shell was invoked
+    :type channel: paramiko.channel.Channel
+    """
+
+    def __init__(self, channel: Channel, bufsize: int = 32768) -> None:
+        self.channel = channel
+        self.bufsize = bufsize
+
+    def __enter__(self) -> PersistentShell:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.channel.close()
+
+    def run(self, command: str, timeout: float | None = None) -> tuple[bytes, bytes, int]:
+        """Run a command in the shell and wait for it to complete.
+        The command stdin is /dev/null, and the command must not exit the shell.
+
+        :param command: the command to execute. It must be a complete shell command,
+        e.g. without an unbalanced quote, otherwise the shell keeps reading the
+        lines sent after it and the command never completes.
+        :type command: str
+        :param timeout: the maximum time in seconds to wait for the command, None to wait forever
+        :type timeout: float
+        :returns the stdout, the stderr and the exit status of the command
+        :rtype: tuple(bytes, bytes, int)
+
+        :raises SSHException: if the shell exits before the command completes
+        :raises socket.timeout: if the command did not complete in time, the shell
+        is then in an unknown state and must be closed
+        """
+        end = SHELL_END_MARKER.decode()
+        rc = SHELL_RC_MARKER.decode()
+        self.channel.sendall((
+            f"{{ {command}\n}} </dev/null\n"
+            f"printf '\\n{rc}%d {end}\\n' $?\n"
+            f"printf '\\n{end}\\n' >&2\n"
+        ).encode())
+
+        stdout = bytearray()
+        stderr = bytearray()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not (stdout.endswith(SHELL_END_MARKER + b"\n") and stderr.endswith(SHELL_END_MARKER + b"\n")):
+            if self.channel.recv_ready():
+                stdout += self.channel.recv(self.bufsize)
+            elif self.channel.recv_stderr_ready():
+                stderr += self.channel.recv_stderr(self.bufsize)
+            elif self.channel.closed or self.channel.eof_received:
+                raise SSHException(f"Shell exited while running: {command}")
+            else:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout(f"Command did not complete in {timeout} seconds: {command}")
+                select.select([self.channel], [], [], remaining)
+
+        status_at = stdout.rindex(b"\n" + SHELL_RC_MARKER)
+        status = int(stdout[status_at + len(SHELL_RC_MARKER) + 1:].split()[0])
+        return (
+            bytes(stdout[:status_at]),
+            bytes(stderr[:stderr.rindex(b"\n" + SHELL_END_MARKER)]),
+            status,
+        )
+
 
 class Connection:
     """Represents a SSH connection with an SSH server.
     """
 
-    def __init__(self, client: SSHClient, forward_agent: bool, sudoable: bool) -> None:
+    def __init__(self, client: SSHClient, forward_agent: bool, sudoable: bool, keepalive_interval: int = 30, require_pty: bool = False) -> None:
         self.client = client
         self.transport = client.get_transport()
         self.forward_agent = forward_agent
         self.sudoable = sudoable
+        self.require_pty = require_pty
+        self._sftp: SFTPClient | None = None
+        if self.transport is not None:
+            # keep idle connections alive through NATs and firewalls
+            self.transport.set_keepalive(keepalive_interval)
+            sock = self.transport.sock
+            # the socket is a ProxyCommand when connecting through a proxy
+            if isinstance(sock, socket.socket):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @property
+    def sftp(self) -> SFTPClient:
+        """The SFTP session of the connection, opened on first use."""
+        if self._sftp is None:
+            assert self.transport is not None
+            sftp = SFTPClient.from_transport(self.transport)
+            assert sftp is not None
+            self._sftp = sftp
+        return self._sftp
+
+    def close_sftp(self) -> None:
+        """Close the SFTP session of the connection, if any."""
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
 
-    def sudo_command(self, command: str, passwd: str, bufsize: int = -1) -> tuple[ChannelFile, ChannelFile, ChannelFile]:
-        new_command = f"sudo {command}"
-        return self.exec_command(new_command, passwd, bufsize)
-
-    def exec_command(self, command: str, passwd: str, bufsize: int = -1, check_status: bool = True) -> tuple[ChannelFile, ChannelFile, ChannelFile]:
-        assert self.transport is not None
-        chan = self.client.invoke_shell()
-        chan.exec_command(command)
-        output = chan.recv(1024).decode('utf-8')
-        if 'Password for' in output:
-            chan.send(f"{passwd}\n")
-        stdin = chan.makefile('wb', bufsize)
-        stdout = chan.makefile('rb', bufsize)
-        stderr = chan.makefile_stderr('rb', bufsize)
-        return (stdin, stdout, stderr)
-    
     def put_file(self, local_path: str, remote_path: str) -> None:
         """Put a file on the SSH server.
 
@@ -64,12 +238,44 @@ class Connection:
         :param remote_path: the remote path to put the file
         :type remote_path: str
         """
-        assert self.transport is not None
-        sftp = self.transport.open_sftp_client()
-        sftp.put(local_path, remote_path)
-        sftp.close()
+        self.sftp.put(local_path, remote_path)
+
+    def put_files(self, paths: list[tuple[str, str]]) -> None:
+        """Put several files on the SSH server, over the same SFTP session.
+
+        :param paths: the local path and the remote path of every file to put
+        :type paths: list of tuple(str, str)
+        """
+        for local_path, remote_path in paths:
+            self.sftp.put(local_path, remote_path)
 
-    def sudo_command(self, command: str, bufsize: int = -1) -> tuple[ChannelFile, ChannelFile, ChannelFile]:
+    def put_archive(self, local_paths: list[str], remote_dir: str) -> None:
+        """Put several files in a directory of the SSH server, streamed as a
+        single tar archive through one channel. Faster than SFTP for many small
+        files, it needs tar on the server.
+
+        :param local_paths: the local paths of the files to put
+        :type local_paths: list of str
+        :param remote_dir: the existing remote directory to put the files in
+        :type remote_dir: str
+
+        :raises RuntimeError: if the archive could not be extracted
+        """
+        assert self.transport is not None
+        # no pty, it would mangle the binary stream
+        channel = self.transport.open_session()
+        command = f"tar xf - -C {shlex.quote(remote_dir)}"
+        # the transport may outlive the connection in the pool, the channel must not
+        with closing(channel):
+            channel.exec_command(command)
+            with channel.makefile('wb') as stdin, tarfile.open(fileobj=stdin, mode='w|') as archive:
+                for local_path in local_paths:
+                    archive.add(local_path, arcname=os.path.basename(local_path))
+            channel.shutdown_write()
+            if channel.recv_exit_status() != 0:
+                raise RuntimeError(f"Command execution error: {command}")
+
+    def sudo_command(self, command: str, bufsize: int = -1, check_status: bool = True, passwd: str | None = None, pty: bool | None = None) -> tuple[ChannelFile, StdoutFile, ChannelFile]:
         """Sudo a command on the SSH server.
         Delegates to :func`~ssh.Connection.exec_command`
 
@@ -77,15 +283,37 @@ class Connection:
         :type command: str
         :param bufsize: interpreted the same way as by the built-in C{file()} function in python
         :type bufsize: int
+        :param check_staus: if enabled, waits for the command to complete and return an exception
+        if the status is non-zero.
+        :type check_staus: bool
+        :param passwd: the sudo password, if sudo asks for one. Without a pty it is
+        written to the command stdin, which sudo reads with -S, and -k makes sudo
+        ask for it even when the credentials are cached. sudo does not read it on
+        NOPASSWD rules though, the command then gets it on its stdin, so do not
+        give it for those. With a pty it is sent once sudo prompts for it. Without
+        a password sudo runs with -n and fails instead of waiting for one.
+        :type passwd: str
+        :param pty: request a pty, only needed when sudoers requires a tty.
+        Defaults to the require_pty of the connection.
+        :type pty: bool
         :returns the stdin, stdout, and stderr of the executing command
         :rtype: tuple(L{ChannelFile}, L{ChannelFile}, L{ChannelFile})
 
         :raises SSHException: if the server fails to execute the command
         """
-        new_command = f"sudo {command}"
-        return self.exec_command(new_command, bufsize)
-
-    def exec_command(self, command: str, bufsize: int = -1, check_status: bool = True) -> tuple[ChannelFile, ChannelFile, ChannelFile]:
+        if pty is None:
+            pty = self.require_pty
+        if passwd is None:
+            return self.exec_command(f"sudo -n {command}", bufsize, check_status, pty=pty)
+        if pty:
+            # A pty echoes what is written before sudo turns echo off, so the
+            # password is only sent once sudo prompts for it. -k makes sure it does.
+            return self.exec_command(f"sudo -k {command}", bufsize, check_status, prompt_passwd=passwd, pty=True)
+        # An empty prompt keeps sudo from writing to the command output, and -k
+        # from leaving the password to the command when the credentials are cached
+        return self.exec_command(f"sudo -k -S -p '' {command}", bufsize, check_status, stdin_data=f"{passwd}\n", pty=False)
+
+    def exec_command(self, command: str, bufsize: int = -1, check_status: bool = True, stdin_data: str | None = None, prompt_passwd: str | None = None, pty: bool | None = None) -> tuple[ChannelFile, StdoutFile, ChannelFile]:
         """Execute a command on the SSH server while preserving underling
         agent forwarding and sudo privileges.
         https://github.com/paramiko/paramiko/blob/1.8/paramiko/client.py#L348
@@ -95,11 +323,50 @@ class Connection:
         :param bufsize: interpreted the same way as by the built-in C{file()} function in python
         :type bufsize: int
         :param check_staus: if enabled, waits for the command to complete and return an exception
-        if the status is non-zero.
+        if the status is non-zero. Otherwise returns as soon as the command is started,
+        the channel is available as stdout.channel to wait for the exit status later.
         :type check_staus: bool
+        :param stdin_data: data written to the command stdin once it is started
+        :type stdin_data: str
+        :param prompt_passwd: password sent once the command prompts for it. If the
+        command completes without prompting, stdout is an in memory file of its output.
+        :type prompt_passwd: str
+        :param pty: request a pty, defaults to the require_pty of the connection.
+        :type pty: bool
         :returns the stdin, stdout, and stderr of the executing command
         :rtype: tuple(L{ChannelFile}, L{ChannelFile}, L{ChannelFile})
 
+        :raises SSHException: if the server fails to execute the command
+        """
+        channel = self.exec_command_async(command, pty)
+        output = None
+        if prompt_passwd is not None:
+            output = _send_password_on_prompt(channel, prompt_passwd)
+        stdin = channel.makefile('wb', bufsize)
+        stdout: StdoutFile = channel.makefile('rb', bufsize)
+        if output is not None:
+            stdout = io.BytesIO(output)
+        stderr = channel.makefile_stderr('rb', bufsize)
+        if stdin_data is not None:
+            stdin.write(stdin_data)
+            stdin.flush()
+
+        if check_status and channel.recv_exit_status() != 0:
+            raise RuntimeError(f"Command execution error: {command}")
+        return (stdin, stdout, stderr)
+
+    def exec_command_async(self, command: str, pty: bool | None = None) -> Channel:
+        """Start a command on the SSH server, without waiting for it to complete.
+        Several commands can be waited for at once with :func:`~ssh.wait_for_channels`.
+
+        :param command: the command to execute
+        :type command: str
+        :param pty: request a pty, defaults to the require_pty of the connection.
+        A pty merges stderr into stdout and echoes the input, avoid it when possible.
+        :type pty: bool
+        :returns the channel executing the command
+        :rtype: paramiko.channel.Channel
+
         :raises SSHException: if the server fails to execute the command
         """
         assert self.transport is not None
@@ -107,24 +374,375 @@ class Connection:
 
         if self.forward_agent:
             AgentRequestHandler(channel)
-        if self.sudoable:
+        if self.require_pty if pty is None else pty:
             channel.get_pty()
 
         channel.exec_command(command)
-        if check_status and channel.recv_exit_status() != 0:               # 
-            raise RuntimeError(f"Command execution error: {command}")      #
-        # time.sleep(2)
+        return channel
+
+    def wait_for_command(self, host: str, stdout: StdoutFile, stderr: ChannelFile, report: bool = True) -> int:
+        """Wait for a command started with check_status disabled to complete.
+        Its stdout and stderr are read in turns as they arrive, so that the one
+        left unread does not fill the channel window and stall the command.
+
+        :param host: the host where the command is running
+        :type host: str
+        :param stdout: the stdout of the command
+        :type stdout: L{ChannelFile}
+        :param stderr: the stderr of the command
+        :type stderr: L{ChannelFile}
+        :param report: print the output as it arrives, see :func:`~ssh.report_stdout`
+        :type report: bool
+        :returns the exit status of the command
+        :rtype: int
+        """
+        if not isinstance(stdout, ChannelFile):
+            # the command completed while waiting for a password prompt
+            if report:
+                report_stdout(host, stdout)
+            return 0
+        channel = stdout.channel
+        out, err = (stdout_reporter(host), stderr_reporter(host)) if report else (None, None)
+        while True:
+            if channel.recv_ready():
+                data = channel.recv(REPORT_CHUNK_SIZE)
+                if out is not None:
+                    out.feed(data)
+            elif channel.recv_stderr_ready():
+                data = channel.recv_stderr(REPORT_CHUNK_SIZE)
+                if err is not None:
+                    err.feed(data)
+            elif channel.exit_status_ready():
+                # the exit status is sent after all the output
+                break
+            else:
+                select.select([channel], [], [])
+        if out is not None and err is not None:
+            out.close()
+            err.close()
+        return channel.recv_exit_status()
+
+    def open_persistent_shell(self) -> PersistentShell:
+        """Open a shell on the SSH server in which several commands can be run
+        one after another without opening a new channel for each of them.
+        No pty is requested, so stdout and stderr are kept apart and nothing is echoed.
+
+        :returns the shell, to be closed when done
+        :rtype: PersistentShell
+
+        :raises SSHException: if the server fails to invoke the shell
+        """
+        assert self.transport is not None
+        channel = self.transport.open_session()
+        if self.forward_agent:
+            AgentRequestHandler(channel)
+        channel.invoke_shell()
+        return PersistentShell(channel)
 
-        stdin = channel.makefile('wb', bufsize)
-        # stdin.write("<PASSWPRD>")
-        # stdin.flush()
-        stdout = channel.makefile('rb', bufsize)
-        stderr = channel.makefile_stderr('rb', bufsize)
-        return (stdin, stdout, stderr)
+    def exec_batch(self, commands: list[str], bufsize: int = -1, independent: bool = False, check_status: bool = True) -> tuple[ChannelFile, StdoutFile, ChannelFile]:
+        """Execute several commands on the SSH server with a single channel.
+        Delegates to :func`~ssh.Connection.exec_command`
+
+        The commands are passed to the remote shell as they are, arguments
+        containing shell metacharacters must be quoted with shlex.quote.
+
+        :param commands: the commands to execute, in order
+        :type commands: list of str
+        :param bufsize: interpreted the same way as by the built-in C{file()} function in python
+        :type bufsize: int
+        :param independent: if enabled, run every command even if a previous one failed,
+        otherwise stop at the first failing command
+        :type independent: bool
+        :param check_staus: if enabled, waits for the commands to complete and return an exception
+        if the status is non-zero.
+        :type check_staus: bool
+        :returns the stdin, stdout, and stderr of the executing commands
+        :rtype: tuple(L{ChannelFile}, L{ChannelFile}, L{ChannelFile})
+
+        :raises SSHException: if the server fails to execute the commands
+        """
+        separator = "; " if independent else " && "
+        return self.exec_command(separator.join(commands), bufsize, check_status)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_ssh_config() -> SSHConfig:
+    """Parse the user ssh config at ~/.ssh/config once per process.
+
+    :returns the user ssh config, empty if there is none
+    :rtype: SSHConfig
+    """
+    ssh_config = SSHConfig()
+    user_config_file = os.path.expanduser("~/.ssh/config")
+    if os.path.exists(user_config_file):
+        with open(user_config_file) as f:
+            ssh_config.parse(f)
+    return ssh_config
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_host_config(host: str) -> dict[str, Any]:
+    """Return the options of the user ssh config which apply to host.
+    The result is shared between calls and must not be modified.
+
+    :param host: the server to connect to
+    :type host: str
+    :rtype: dict
+    """
+    return _load_ssh_config().lookup(host)
+
+
+def wait_for_channels(channels: list[Channel], timeout: float | None = None, bufsize: int = 32768) -> list[tuple[bytes, bytes, int]]:
+    """Wait for the commands executing on several channels to complete, from
+    a single thread. The outputs are read as they arrive, so the total time is
+    the one of the slowest command rather than the sum of all of them.
+
+    :param channels: the channels returned by :func:`~ssh.Connection.exec_command_async`
+    :type channels: list of paramiko.channel.Channel
+    :param timeout: the maximum time in seconds to wait for all the commands, None to wait forever
+    :type timeout: float
+    :param bufsize: the maximum number of bytes read at once
+    :type bufsize: int
+    :returns the stdout, the stderr and the exit status of every command, in the order of channels
+    :rtype: list of tuple(bytes, bytes, int)
+
+    :raises socket.timeout: if the commands did not complete in time
+    """
+    outputs = {channel: (bytearray(), bytearray()) for channel in channels}
+    statuses: dict[Channel, int] = {}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pending = list(channels)
+    while pending:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise socket.timeout(f"{len(pending)} commands did not complete in {timeout} seconds")
+        readable, _, _ = select.select(pending, [], [], remaining)
+        for channel in readable:
+            stdout, stderr = outputs[channel]
+            while channel.recv_ready():
+                stdout += channel.recv(bufsize)
+            while channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(bufsize)
+            # the exit status is sent after all the output
+            if channel.exit_status_ready() and not (channel.recv_ready() or channel.recv_stderr_ready()):
+                statuses[channel] = channel.recv_exit_status()
+                pending.remove(channel)
+    return [
+        (bytes(outputs[channel][0]), bytes(outputs[channel][1]), statuses[channel])
+        for channel in channels
+    ]
+
+
+def _freeze(value: Any) -> Any:
+    """Return a hashable equivalent of a connect option value."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _is_alive(client: SSHClient) -> bool:
+    """Check whether the transport of an SSH client can still be used.
+
+    :param client: the client to check
+    :type client: SSHClient
+    :rtype: bool
+    """
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.send_ignore()
+    except (SSHException, OSError):
+        return False
+    return True
+
+
+def retry_connect(host: str, connect: Callable[[], T], max_attempts: int, max_timeout: int) -> T:
+    """Call connect until it does not raise an OSError or an SSHException, at
+    most max_attempts times. Authentication and host key failures are not
+    transient, they are raised right away.
+
+    :param host: the server to connect to
+    :type host: str
+    :param connect: the function establishing the connection
+    :type connect: callable
+    :param max_attempts: the maximum attempts to connect to the desired host
+    :type max_attempts: int
+    :param max_timeout: the maximum timeout in seconds to sleep between attempts,
+    the sleep starts at RETRY_BACKOFF_SECS and doubles after every attempt
+    :type max_timeout: int
+    :returns the result of connect
+
+    :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
+    to establish the SSH connection.
+    :raises AuthenticationException: if the server rejected the credentials
+    :raises BadHostKeyException: if the host key did not match
+    """
+    attempts = 0
+    while attempts < max_attempts:
+        try:
+            attempts += 1
+            return connect()
+        except (AuthenticationException, BadHostKeyException):
+            raise
+        except (OSError, SSHException) as e:
+            # e.g. a banner timeout or a reset during the key exchange
+            if attempts < max_attempts:
+                print(f"SSH to host {host} failed, retrying...")
+                # exponential backoff, with jitter so that parallel reconnects spread out
+                time.sleep(min(max_timeout, RETRY_BACKOFF_SECS * 2 ** attempts + random.uniform(0, RETRY_BACKOFF_SECS)))
+            else:
+                print(f"SSH Exception: {e}")
+
+    raise MaxConnectionAttemptsError(
+        f"Exceeded max attempts to connect to host {host} after {max_attempts} retries"
+    )
+
+
+def _connect(host: str, cfg: dict[str, Any], max_attempts: int, max_timeout: int, proxy_command: str | None = None) -> SSHClient:
+    """Establish a new SSH connection to the desired host.
+
+    :param host: the server to connect to
+    :type host: str
+    :param cfg: the arguments of :func:`SSHClient.connect`
+    :type cfg: dict
+    :param max_attempts: the maximum attempts to connect to the desired host
+    :type max_attempts: int
+    :param max_timeout: the maximum timeout in seconds to sleep between attempts
+    :type max_timeout: int
+    :param proxy_command: the ProxyCommand from the ssh config, if any
+    :type proxy_command: str
+    :returns a connected SSH client
+    :rtype: SSHClient
+
+    :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
+    to establish the SSH connection.
+    """
+    def attempt() -> SSHClient:
+        # a failed connect can leave the client, and the proxy stream, half
+        # way through the handshake, so every attempt starts from scratch
+        client = SSHClient()
+        # the known_hosts files are not loaded, so no host key file is parsed on
+        # connect and unknown keys are only added to the in memory HostKeys
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        attempt_cfg = dict(cfg, sock=ProxyCommand(proxy_command)) if proxy_command else cfg
+        try:
+            client.connect(**attempt_cfg)
+        except BaseException:
+            client.close()
+            if proxy_command:
+                attempt_cfg["sock"].close()
+            raise
+        return client
+
+    return retry_connect(host, attempt, max_attempts, max_timeout)
+
+
+class SSHConnectionPool:
+    """Keeps established SSH clients after use, so that later connections
+    to the same host with the same options skip the TCP, key exchange
+    and authentication handshake.
+
+    :param max_idle: the seconds an idle client is kept before being closed
+    :type max_idle: int
+    :param max_per_host: the maximum number of idle clients kept for each key
+    :type max_per_host: int
+    """
+
+    def __init__(self, max_idle: int = 60, max_per_host: int = 4) -> None:
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._idle: dict[PoolKey, queue.Queue[tuple[float, SSHClient]]] = {}
+
+    @staticmethod
+    def key(host: str, cfg: dict[str, Any]) -> PoolKey:
+        """Return the pool key of a connection to host with the given config.
+        Every option changing the transport or the authentication is part of it,
+        so that a client is only shared between identical connections.
+        """
+        return (host, tuple(sorted(
+            (option, _freeze(value))
+            for option, value in cfg.items()
+            if option not in POOL_KEY_IGNORED_OPTIONS
+        )))
+
+    def _queue(self, key: PoolKey) -> queue.Queue[tuple[float, SSHClient]]:
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.Queue(maxsize=self.max_per_host)
+            return self._idle[key]
+
+    def borrow(self, host: str, cfg: dict[str, Any], max_attempts: int = 1, max_timeout: int = 5, proxy_command: str | None = None) -> SSHClient:
+        """Return a live idle client for the host, or connect a new one.
+
+        :param host: the server to connect to
+        :type host: str
+        :param cfg: the arguments of :func:`SSHClient.connect`
+        :type cfg: dict
+        :param max_attempts: the maximum attempts to connect to the desired host
+        :type max_attempts: int
+        :param max_timeout: the maximum timeout in seconds to sleep between attempts
+        :type max_timeout: int
+        :param proxy_command: the ProxyCommand from the ssh config, if any
+        :type proxy_command: str
+        :rtype: SSHClient
+
+        :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
+        to establish the SSH connection.
+        """
+        idle = self._queue(self.key(host, cfg))
+        while True:
+            try:
+                released_at, client = idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - released_at <= self.max_idle and _is_alive(client):
+                return client
+            client.close()
+        return _connect(host, cfg, max_attempts, max_timeout, proxy_command)
+
+    def release(self, host: str, cfg: dict[str, Any], client: SSHClient) -> None:
+        """Give a client back to the pool. Dead clients, and clients exceeding
+        max_per_host, are closed instead.
+
+        :param host: the server the client is connected to
+        :type host: str
+        :param cfg: the arguments the client was connected with
+        :type cfg: dict
+        :param client: the client to give back
+        :type client: SSHClient
+        """
+        if not _is_alive(client):
+            client.close()
+            return
+        try:
+            self._queue(self.key(host, cfg)).put_nowait((time.monotonic(), client))
+        except queue.Full:
+            client.close()
+
+    def close(self) -> None:
+        """Close all the idle clients."""
+        with self._lock:
+            queues = list(self._idle.values())
+            self._idle.clear()
+        for idle in queues:
+            while True:
+                try:
+                    _, client = idle.get_nowait()
+                except queue.Empty:
+                    break
+                client.close()
+
+
+connection_pool = SSHConnectionPool()
+atexit.register(connection_pool.close)
 
 
 @contextmanager
-def ssh(host: str, forward_agent: bool = False, sudoable: bool = False, max_attempts: int = 1, max_timeout: int = 5, ssh_password: str | None = None) -> Iterator[Connection]:
+def ssh(host: str, forward_agent: bool = False, sudoable: bool = False, max_attempts: int = 1, max_timeout: int = 5, ssh_password: str | None = None, pooled: bool = True, keepalive_interval: int = 30, backend: str | None = None, disabled_algorithms: dict[str, list[str]] | None = None, require_pty: bool = False, compress: bool = True, auth_timeout: float = 30) -> Iterator[Union[Connection, Ssh2Connection, OpenSSHConnection]]:
     """Manages a SSH connection to the desired host.
        Will leverage your ssh config at ~/.ssh/config if available
 
@@ -132,7 +750,8 @@ def ssh(host: str, forward_agent: bool = False, sudoable: bool = False, max_atte
     :type host: str
     :param forward_agent: forward the local agents
     :type forward_agent: bool
-    :param sudoable: allow sudo commands
+    :param sudoable: no longer has any effect, kept for compatibility: sudo
+    commands can always be run, see require_pty for the hosts requiring a tty
     :type sudoable: bool
     :param max_attempts: the maximum attempts to connect to the desired host
     :type max_attempts: int
@@ -140,62 +759,185 @@ def ssh(host: str, forward_agent: bool = False, sudoable: bool = False, max_atte
     :type max_timeout: int
     :param ssh_password: SSH password to use if needed
     :type ssh_password: str
+    :param pooled: reuse an idle connection to the host from the connection
+    pool if any, and give the connection back to the pool when done
+    :type pooled: bool
+    :param keepalive_interval: the seconds between SSH keepalive packets, 0 to disable
+    :type keepalive_interval: int
+    :param backend: the SSH library to use, either paramiko, ssh2 (libssh2, needs
+    the ssh2-python package, ProxyCommand is not supported) or openssh (the ssh command, with connections to the
+    same host multiplexed, ssh_password is not supported and raises ValueError). Defaults to the
+    KAFKA_UTILS_SSH_BACKEND environment variable, or paramiko if not set.
+    :type backend: str
+    :param disabled_algorithms: the algorithms paramiko must not negotiate, e.g.
+    {"pubkeys": ["rsa-sha2-512", "rsa-sha2-256"]} for servers only supporting ssh-rsa
+    keys. Requires paramiko >= 2.6.
+    :type disabled_algorithms: dict
+    :param require_pty: request a pty for every command, only needed when sudoers
+    requires a tty. Sudo otherwise runs without a pty, with -n when no password is given.
+    :type require_pty: bool
+    :param compress: compress the SSH traffic with zlib, if the server supports it.
+    Broker logs compress well, disable on fast networks where CPU matters more.
+    :type compress: bool
+    :param auth_timeout: the maximum time in seconds to wait for the authentication
+    :type auth_timeout: float
     :returns a SSH connection to the desired host
     :rtype: Connection
 
     :raises MaxConnectionAttemptsError: Exceeded the maximum attempts
     to establish the SSH connection.
+    :raises ValueError: if the backend is unknown or does not support the options
     """
-    with closing(SSHClient()) as client:
-        client.set_missing_host_key_policy(AutoAddPolicy())
-
-        cfg = {
-            "hostname": host,
-            "timeout": max_timeout,
-        }
+    cfg: dict[str, Any] = {
+        "hostname": host,
+        "timeout": max_timeout,
+        # do not wait for the default 15 seconds on hung servers
+        "banner_timeout": max_timeout,
+        "auth_timeout": auth_timeout,
+        "compress": compress,
+    }
+    if ssh_password:
+        cfg['password'] = ssh_password
+    if disabled_algorithms:
+        cfg['disabled_algorithms'] = disabled_algorithms
+
+    proxy_command = None
+    host_config = _lookup_host_config(host)
+    if "user" in host_config:
+        cfg["username"] = host_config["user"]
+
+    if "proxycommand" in host_config:
+        proxy_command = host_config["proxycommand"]
+
+    if "identityfile" in host_config:
+        cfg['key_filename'] = host_config['identityfile']
+
+    if "port" in host_config:
+        cfg["port"] = int(host_config["port"])
+
+    backend = backend or os.environ.get(SSH_BACKEND_ENV) or "paramiko"
+    if backend not in SSH_BACKENDS:
+        raise ValueError(f"Unknown SSH backend {backend}, expected one of {', '.join(SSH_BACKENDS)}")
+
+    if backend == "ssh2":
+        if proxy_command:
+            raise ValueError(f"The ssh2 backend does not support the ProxyCommand configured for {host}")
+        # ssh2-python is optional, only import it when asked for
+        from kafka_utils.util import libssh2
+        with closing(libssh2.connect(host, cfg, max_attempts, max_timeout, forward_agent, sudoable, require_pty)) as ssh2_connection:
+            yield ssh2_connection
+        return
+
+    if backend == "openssh":
         if ssh_password:
-            cfg['password'] = ssh_password
-
-        ssh_config = SSHConfig()
-        user_config_file = os.path.expanduser("~/.ssh/config")
-        if os.path.exists(user_config_file):
-            with open(user_config_file) as f:
-                ssh_config.parse(f)
-                host_config = ssh_config.lookup(host)
-                if "user" in host_config:
-                    cfg["username"] = host_config["user"]
-
-                if "proxycommand" in host_config:
-                    cfg["sock"] = ProxyCommand(host_config["proxycommand"])
-
-                if "identityfile" in host_config:
-                    cfg['key_filename'] = host_config['identityfile']
-
-                if "port" in host_config:
-                    cfg["port"] = int(host_config["port"])
-
-        attempts = 0
-        while attempts < max_attempts:
-            try:
-                attempts += 1
-                client.connect(**cfg)  # type: ignore[arg-type]
-                break
-            except OSError as e:
-                if attempts < max_attempts:
-                    print(f"SSH to host {host} failed, retrying...")
-                    time.sleep(max_timeout)
-                else:
-                    print(f"SSH Exception: {e}")
-
-        else:
-            raise MaxConnectionAttemptsError(
-                f"Exceeded max attempts to connect to host {host} after {max_attempts} retries"
-            )
+            raise ValueError("The openssh backend does not support ssh_password")
+        from kafka_utils.util import openssh
+        with closing(openssh.connect(host, max_attempts, max_timeout, forward_agent, sudoable, require_pty, compress)) as openssh_connection:
+            yield openssh_connection
+        return
+
+    if not pooled:
+        with closing(_connect(host, cfg, max_attempts, max_timeout, proxy_command)) as client:
+            yield Connection(client, forward_agent, sudoable, keepalive_interval, require_pty)
+        return
+
+    client = connection_pool.borrow(host, cfg, max_attempts, max_timeout, proxy_command)
+    connection = Connection(client, forward_agent, sudoable, keepalive_interval, require_pty)
+    try:
+        yield connection
+    except BaseException:
+        client.close()
+        raise
+    connection.close_sftp()
+    connection_pool.release(host, cfg, client)
+
+
+def _chunk_reader(remote: ChannelFile | IO[bytes]) -> Callable[[], bytes]:
+    """Return a function reading the next chunk of a remote file as soon as
+    some of it arrived. The read() of a ChannelFile waits until the whole size
+    is received, so the channel is read directly. The file must not have been
+    read from before.
+
+    :param remote: the remote file to read
+    :type remote: paramiko.channel.ChannelFile or IO[bytes]
+    :rtype: callable
+    """
+    if isinstance(remote, ChannelStderrFile):
+        return functools.partial(remote.channel.recv_stderr, REPORT_CHUNK_SIZE)
+    if isinstance(remote, ChannelFile):
+        return functools.partial(remote.channel.recv, REPORT_CHUNK_SIZE)
+    # the in memory files of the other backends
+    return functools.partial(remote.read, REPORT_CHUNK_SIZE)
+
+
+class LineReporter:
+    """Writes the lines of a stream to output as chunks of it are fed, the
+    complete lines of a chunk at once. The header is printed to stdout before
+    the first line, if there are any.
+
+    :param header: the line printed before the output
+    :type header: str
+    :param output: the local binary stream to write to
+    :type output: BinaryIO
+    """
 
-        yield Connection(client, forward_agent, sudoable)
+    def __init__(self, header: str, output: BinaryIO) -> None:
+        self.header = header
+        self.output = output
+        self.buf = b""
+
+    def feed(self, chunk: bytes) -> None:
+        out = b""
+        if self.header:
+            out = f"{self.header}\n".encode()
+            self.header = ""
+            if self.output is not sys.stdout.buffer:
+                sys.stdout.buffer.write(out)
+                sys.stdout.buffer.flush()
+                out = b""
+        lines = (self.buf + chunk).split(b"\n")
+        # the last piece is an incomplete line, kept for the next chunk
+        self.buf = lines.pop()
+        # the complete lines of a chunk are written at once, not line by line
+        out += b"".join(line.rstrip() + b"\n" for line in lines)
+        if out:
+            self.output.write(out)
+            self.output.flush()
+
+    def close(self) -> None:
+        """Write the last line, even without a trailing newline."""
+        if self.buf:
+            self.output.write(self.buf.rstrip() + b"\n")
+            self.output.flush()
+            self.buf = b""
+
+
+def stdout_reporter(host: str) -> LineReporter:
+    """Return the reporter printing the stdout of a command running on host."""
+    return LineReporter(f"STDOUT from {host}:", sys.stdout.buffer)
+
+
+def stderr_reporter(host: str) -> LineReporter:
+    """Return the reporter printing the stderr of a command running on host."""
+    return LineReporter(f"STDERR from {host}:", sys.stderr.buffer)
+
+
+def _report_lines(reporter: LineReporter, remote: ChannelFile | IO[bytes]) -> None:
+    """Stream the lines of a remote file to a reporter as they arrive, so that
+    the output of long commands is neither buffered in memory nor delayed
+    until the command completes.
+
+    :param reporter: the reporter writing the lines
+    :type reporter: LineReporter
+    :param remote: the remote file to read
+    :type remote: paramiko.channel.ChannelFile or IO[bytes]
+    """
+    for chunk in iter(_chunk_reader(remote), b""):
+        reporter.feed(chunk)
+    reporter.close()
 
 
-def report_stdout(host: str, stdout: ChannelFile) -> None:
+def report_stdout(host: str, stdout: ChannelFile | IO[bytes]) -> None:
     """Take a stdout and print it's lines to output if lines are present.
 
     :param host: the host where the process is running
@@ -203,14 +945,10 @@ def report_stdout(host: str, stdout: ChannelFile) -> None:
     :param stdout: the std out of that process
     :type stdout: paramiko.channel.Channel
     """
-    lines = stdout.readlines()
-    if lines:
-        print(f"STDOUT from {host}:")
-        for line in lines:
-            print(line.rstrip(), file=sys.stdout)
+    _report_lines(stdout_reporter(host), stdout)
 
 
-def report_stderr(host: str, stderr: ChannelFile) -> None:
+def report_stderr(host: str, stderr: ChannelFile | IO[bytes]) -> None:
     """Take a stderr and print it's lines to output if lines are present.
 
     :param host: the host where the process is running
@@ -218,8 +956,4 @@ def report_stderr(host: str, stderr: ChannelFile) -> None:
     :param stderr: the std error of that process
     :type stderr: paramiko.channel.Channel
     """
-    lines = stderr.readlines()
-    if lines:
-        print(f"STDERR from {host}:")
-        for line in lines:
-            print(line.rstrip(), file=sys.stderr)
+    _report_lines(stderr_reporter(host), stderr)
@@ -61,6 +61,9 @@ setup(
         "tenacity",
         "typing-extensions>=3.7.4",
     ],
+    extras_require={
+        "ssh2": ["ssh2-python"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: Apache Software License",
@@ -20,3 +20,9 @@ def before_scenario(context, scenario):
     topics = list_topics()
     for topic in topics.split('\n'):
         delete_topic(topic)
+
+
+def after_scenario(context, scenario):
+    """Close the ZooKeeper session opened by the steps, if any"""
+    if 'zk' in context:
+        context.zk.__exit__(None, None, None)
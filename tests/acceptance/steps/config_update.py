@@ -16,12 +16,10 @@ import time
 from behave import then
 from behave import when
 from kafka.errors import MessageSizeTooLargeError
-from steps.util import get_cluster_config
+from steps.util import get_zk
 from steps.util import produce_example_msg
 from steps.util import update_topic_config
 
-from kafka_utils.util.zookeeper import ZK
-
 
 @when('we set the configuration of the topic to 0 bytes')
 def step_impl1(context):
@@ -29,6 +27,8 @@ def step_impl1(context):
         context.topic,
         'max.message.bytes=0'
     )
+    # the config changed behind the back of the ZK session
+    context.last_topic_config = None
 
 
 @then('we produce to a kafka topic it should fail')
@@ -42,11 +42,11 @@ def step_impl2(context):
 
 @when('we change the topic config in zk to 10000 bytes for kafka 10')
 def step_impl3(context):
-    cluster_config = get_cluster_config()
-    with ZK(cluster_config) as zk:
-        current_config = zk.get_topic_config(context.topic)
-        current_config['config']['max.message.bytes'] = '1000'
-        zk.set_topic_config(context.topic, value=current_config)
+    zk = get_zk(context)
+    current_config = getattr(context, 'last_topic_config', None) or zk.get_topic_config(context.topic)
+    current_config['config']['max.message.bytes'] = '1000'
+    zk.set_topic_config(context.topic, value=current_config)
+    context.last_topic_config = current_config
     time.sleep(2)  # sleeping for 2 seconds to ensure config is actually picked up
 
 
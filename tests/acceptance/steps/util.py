@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import json
 import subprocess
 import time
@@ -22,6 +23,7 @@ from kafka.common import LeaderNotAvailableError
 from kafka_utils.util import config
 from kafka_utils.util.client import KafkaToolClient
 from kafka_utils.util.offsets import set_consumer_offsets
+from kafka_utils.util.zookeeper import ZK
 
 
 ZOOKEEPER_URL = 'zookeeper:2181'
@@ -37,6 +39,7 @@ def load_json(bytes_or_str):
     return json.loads(data)
 
 
+@functools.lru_cache(maxsize=1)
 def get_cluster_config():
     return config.get_cluster_config(
         'test',
@@ -45,6 +48,14 @@ def get_cluster_config():
     )
 
 
+def get_zk(context):
+    """Return the ZooKeeper session shared by the steps of the scenario,
+    opened on first use and closed by after_scenario"""
+    if 'zk' not in context:
+        context.zk = ZK(get_cluster_config()).__enter__()
+    return context.zk
+
+
 def update_topic_config(topic_name, config):
     cmd = ['kafka-topics.sh', '--alter',
            '--zookeeper', ZOOKEEPER_URL,
@@ -0,0 +1,107 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from unittest import mock
+
+import pytest
+
+from kafka_utils.kafka_disaster_restart import main
+from kafka_utils.kafka_rolling_restart.task import TaskFailedException
+
+
+class RecordingTask:
+
+    def __init__(self, fail_on=None):
+        self.hosts = []
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+
+    def run(self, host):
+        with self.lock:
+            self.hosts.append(host)
+        if host == self.fail_on:
+            raise TaskFailedException()
+
+
+def test_execute_task_in_parallel_runs_on_all_hosts():
+    task = RecordingTask()
+
+    main.execute_task_in_parallel([task], ["host1", "host2", "host3"])
+
+    assert sorted(task.hosts) == ["host1", "host2", "host3"]
+
+
+def test_execute_task_in_parallel_raises_on_failure():
+    task = RecordingTask(fail_on="host2")
+
+    with pytest.raises(TaskFailedException):
+        main.execute_task_in_parallel([task], ["host1", "host2", "host3"])
+
+
+def test_execute_task_in_parallel_no_hosts():
+    task = RecordingTask()
+
+    main.execute_task_in_parallel([task], [])
+
+    assert task.hosts == []
+
+
+@mock.patch('kafka_utils.kafka_rolling_restart.main.start_broker', autospec=True)
+@mock.patch('kafka_utils.kafka_rolling_restart.main.stop_broker', autospec=True)
+@mock.patch('kafka_utils.util.ssh.ssh', autospec=True)
+def test_execute_disaster_restart(mock_ssh, mock_stop, mock_start):
+    events = []
+    pre_stop_task = RecordingTask()
+    post_stop_task = RecordingTask()
+    mock_stop.side_effect = lambda host, *args: events.append(('stop', host))
+    mock_start.side_effect = lambda host, *args: events.append(('start', host))
+
+    main.execute_disaster_restart(
+        [(1, "host1"), (2, "host2")],
+        False,
+        [pre_stop_task],
+        [post_stop_task],
+        "start",
+        "stop",
+    )
+
+    assert sorted(pre_stop_task.hosts) == ["host1", "host2"]
+    assert sorted(post_stop_task.hosts) == ["host1", "host2"]
+    assert events == [
+        ('stop', "host1"),
+        ('stop', "host2"),
+        ('start', "host1"),
+        ('start', "host2"),
+    ]
+
+
+@mock.patch('kafka_utils.kafka_rolling_restart.main.start_broker', autospec=True)
+@mock.patch('kafka_utils.kafka_rolling_restart.main.stop_broker', autospec=True)
+@mock.patch('kafka_utils.util.ssh.ssh', autospec=True)
+def test_execute_disaster_restart_ssh_options(mock_ssh, mock_stop, mock_start):
+    main.execute_disaster_restart(
+        [(1, "host1")],
+        False,
+        [],
+        [],
+        "start",
+        "stop",
+        compress=False,
+        require_pty=True,
+    )
+
+    assert mock_ssh.call_count == 2
+    for call in mock_ssh.call_args_list:
+        assert call[1]["compress"] is False
+        assert call[1]["require_pty"] is True
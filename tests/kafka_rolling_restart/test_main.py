@@ -178,3 +178,28 @@ def test_get_broker_list2(mock_client, mock_get_broker, mock_get_json):
 def test_get_broker_list3(mock_client, mock_get_broker, mock_get_json):
     p = main.get_broker_list(cluster_config, active_controller_for_last=True)
     assert p == [(1, 'broker1'), (3, 'broker3'), (2, 'broker2')]
+
+
+def test_start_broker_streams_output():
+    connection = mock.Mock()
+    connection.sudo_command.return_value = (mock.sentinel.stdin, mock.sentinel.stdout, mock.sentinel.stderr)
+    connection.wait_for_command.return_value = 0
+
+    main.start_broker("host1", connection, "service kafka start", True)
+
+    connection.sudo_command.assert_called_once_with("service kafka start", check_status=False)
+    connection.wait_for_command.assert_called_once_with(
+        "host1",
+        mock.sentinel.stdout,
+        mock.sentinel.stderr,
+        report=True,
+    )
+
+
+def test_stop_broker_fails_on_non_zero_status():
+    connection = mock.Mock()
+    connection.sudo_command.return_value = (mock.Mock(), mock.Mock(), mock.Mock())
+    connection.wait_for_command.return_value = 1
+
+    with pytest.raises(RuntimeError):
+        main.stop_broker("host1", connection, "service kafka stop", False)
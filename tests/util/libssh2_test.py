@@ -0,0 +1,212 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("ssh2")
+
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN  # noqa: E402
+from ssh2.exceptions import AuthenticationError  # noqa: E402
+from ssh2.exceptions import SocketDisconnectError  # noqa: E402
+
+from kafka_utils.util import libssh2  # noqa: E402
+from kafka_utils.util import ssh  # noqa: E402
+from kafka_utils.util.error import MaxConnectionAttemptsError  # noqa: E402
+from kafka_utils.util.libssh2 import Ssh2ChannelFile  # noqa: E402
+from kafka_utils.util.libssh2 import Ssh2Connection  # noqa: E402
+
+
+def mock_channel(stdout=b"", stderr=b"", exit_status=0):
+    channel = mock.Mock()
+    stdout_chunks = [stdout, b""]
+    stderr_chunks = [stderr, b""]
+    channel.read.side_effect = lambda size: (len(stdout_chunks[0]), stdout_chunks.pop(0))
+    channel.read_stderr.side_effect = lambda size: (len(stderr_chunks[0]), stderr_chunks.pop(0))
+    channel.eof.return_value = True
+    channel.get_exit_status.return_value = exit_status
+    return channel
+
+
+def mock_connection(channel, forward_agent=False, sudoable=False, require_pty=False):
+    session = mock.Mock()
+    session.open_session.return_value = channel
+    return Ssh2Connection(session, mock.Mock(), forward_agent, sudoable, require_pty)
+
+
+def test_channel_file_read():
+    channel = mock_channel(stdout=b"line 1\nline 2\n", stderr=b"error\n")
+
+    assert Ssh2ChannelFile(channel).readlines() == [b"line 1\n", b"line 2\n"]
+    assert Ssh2ChannelFile(channel, stderr=True).read(10) == b"error\n"
+
+
+def test_exec_command():
+    channel = mock_channel(stdout=b"output\n", stderr=b"error\n")
+    connection = mock_connection(channel, forward_agent=True, sudoable=True, require_pty=True)
+
+    _, stdout, stderr = connection.exec_command("my command")
+
+    channel.request_auth_agent.assert_called_once_with()
+    channel.pty.assert_called_once_with()
+    channel.execute.assert_called_once_with("my command")
+    assert stdout.read() == b"output\n"
+    assert stderr.read() == b"error\n"
+
+
+def test_exec_command_checks_status():
+    connection = mock_connection(mock_channel(exit_status=1))
+
+    with pytest.raises(RuntimeError):
+        connection.exec_command("false")
+
+
+def test_exec_command_does_not_wait_without_check_status():
+    channel = mock_channel()
+    connection = mock_connection(channel)
+
+    _, stdout, _ = connection.exec_command("sleep 10", check_status=False)
+
+    assert isinstance(stdout, Ssh2ChannelFile)
+    assert not channel.wait_eof.called
+
+
+@mock.patch.object(libssh2.select, 'select', autospec=True)
+def test_exec_command_reads_stdout_and_stderr_in_turns(mock_select):
+    channel = mock.Mock()
+    # stderr arrives first, stdout only once stderr was read
+    channel.read.side_effect = [(LIBSSH2_ERROR_EAGAIN, b""), (6, b"output"), (0, b"")]
+    channel.read_stderr.side_effect = [(5, b"error"), (LIBSSH2_ERROR_EAGAIN, b""), (0, b"")]
+    channel.eof.side_effect = [False, True]
+    channel.get_exit_status.return_value = 0
+    connection = mock_connection(channel)
+    connection.session.block_directions.return_value = 1
+
+    _, stdout, stderr = connection.exec_command("my command")
+
+    assert stdout.read() == b"output"
+    assert stderr.read() == b"error"
+    assert connection.session.set_blocking.call_args_list == [mock.call(False), mock.call(True)]
+    assert not mock_select.called
+
+
+def test_wait_for_command():
+    channel = mock_channel(stdout=b"line 1\n", stderr=b"error\n", exit_status=3)
+    connection = mock_connection(channel)
+    _, stdout, stderr = connection.exec_command("my command", check_status=False)
+
+    with mock.patch.object(libssh2, 'stdout_reporter', autospec=True) as mock_stdout_reporter, \
+            mock.patch.object(libssh2, 'stderr_reporter', autospec=True) as mock_stderr_reporter:
+        assert connection.wait_for_command("host1", stdout, stderr) == 3
+
+    mock_stdout_reporter.return_value.feed.assert_called_once_with(b"line 1\n")
+    mock_stderr_reporter.return_value.feed.assert_called_once_with(b"error\n")
+    channel.close.assert_called_once_with()
+
+
+def test_sudo_command_with_password():
+    channel = mock_channel()
+    connection = mock_connection(channel, sudoable=True)
+
+    connection.sudo_command("service kafka stop", passwd="secret")
+
+    channel.execute.assert_called_once_with("sudo -k -S -p '' service kafka stop")
+    channel.write.assert_called_once_with(b"secret\n")
+
+
+def test_sudo_command_with_password_on_pty():
+    channel = mock_channel()
+    connection = mock_connection(channel, sudoable=True, require_pty=True)
+
+    with pytest.raises(ValueError):
+        connection.sudo_command("service kafka stop", passwd="secret")
+
+    assert not channel.execute.called
+
+
+@mock.patch.object(libssh2, 'Session', autospec=True)
+@mock.patch.object(libssh2.socket, 'create_connection', autospec=True)
+def test_connect(mock_create_connection, mock_session):
+    cfg = {"hostname": "host1", "timeout": 5, "username": "kafka", "password": "secret"}
+
+    connection = libssh2.connect("host1", cfg, 1, 5, False, True)
+
+    mock_create_connection.assert_called_once_with(("host1", 22), 5)
+    session = mock_session.return_value
+    session.handshake.assert_called_once_with(mock_create_connection.return_value)
+    session.userauth_password.assert_called_once_with("kafka", "secret")
+    assert connection.session is session
+    assert connection.sudoable
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+@mock.patch.object(libssh2, 'Session', autospec=True)
+@mock.patch.object(libssh2.socket, 'create_connection', autospec=True)
+def test_connect_retries_ssh2_errors(mock_create_connection, mock_session, mock_sleep):
+    mock_session.return_value.handshake.side_effect = SocketDisconnectError()
+    cfg = {"hostname": "host1", "timeout": 5}
+
+    with pytest.raises(MaxConnectionAttemptsError):
+        libssh2.connect("host1", cfg, 3, 5, False, False)
+
+    assert mock_session.return_value.handshake.call_count == 3
+    assert mock_create_connection.return_value.close.call_count == 3
+
+
+@mock.patch.object(libssh2, 'Session', autospec=True)
+@mock.patch.object(libssh2.socket, 'create_connection', autospec=True)
+def test_connect_does_not_retry_authentication_errors(mock_create_connection, mock_session):
+    mock_session.return_value.userauth_password.side_effect = AuthenticationError()
+    cfg = {"hostname": "host1", "timeout": 5, "username": "kafka", "password": "wrong"}
+
+    with pytest.raises(AuthenticationError):
+        libssh2.connect("host1", cfg, 3, 5, False, False)
+
+    assert mock_session.return_value.handshake.call_count == 1
+
+
+@mock.patch.object(libssh2.os.path, 'exists', autospec=True)
+def test_authenticate_tries_default_keys_before_the_agent(mock_exists):
+    mock_exists.side_effect = lambda path: not path.endswith("id_dsa")
+    session = mock.Mock()
+    session.userauth_publickey_fromfile.side_effect = [AuthenticationError(), AuthenticationError(), None]
+
+    libssh2._authenticate(session, {"username": "kafka", "key_filename": ["/keys/kafka"]})
+
+    expanduser = libssh2.os.path.expanduser
+    assert session.userauth_publickey_fromfile.call_args_list == [
+        mock.call("kafka", "/keys/kafka"),
+        mock.call("kafka", expanduser("~/.ssh/id_rsa")),
+        mock.call("kafka", expanduser("~/.ssh/id_ecdsa")),
+    ]
+    assert not session.agent_auth.called
+
+
+@mock.patch.dict(libssh2.os.environ, {"KAFKA_UTILS_SSH_BACKEND": "ssh2"})
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(libssh2, 'connect', autospec=True)
+def test_ssh_selects_ssh2_backend(mock_connect, mock_lookup):
+    with ssh.ssh("host1", sudoable=True) as connection:
+        assert connection is mock_connect.return_value
+
+    mock_connect.assert_called_once_with(
+        "host1",
+        {"hostname": "host1", "timeout": 5, "banner_timeout": 5, "auth_timeout": 30, "compress": True},
+        1,
+        5,
+        False,
+        True,
+        False,
+    )
+    mock_connect.return_value.close.assert_called_once_with()
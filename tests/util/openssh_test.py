@@ -0,0 +1,129 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import subprocess
+from unittest import mock
+
+import pytest
+
+from kafka_utils.util import openssh
+from kafka_utils.util import ssh
+from kafka_utils.util.error import MaxConnectionAttemptsError
+from kafka_utils.util.openssh import OpenSSHConnection
+
+
+def test_ssh_args_share_control_path():
+    args = openssh.ssh_args("host1", 5, forward_agent=True, require_pty=True)
+
+    assert args[0] == "ssh"
+    assert args[-1] == "host1"
+    assert "ControlMaster=auto" in args
+    assert "-A" in args and "-tt" in args
+    assert "-C" not in args
+    control_path = next(arg for arg in args if arg.startswith("ControlPath="))
+    assert control_path.endswith("/ku-%C")
+    assert control_path in openssh.ssh_args("host2", 5)
+
+
+@mock.patch.object(openssh.subprocess, 'run', autospec=True)
+def test_connect(mock_run):
+    mock_run.return_value = subprocess.CompletedProcess([], 0, b"", b"")
+
+    connection = openssh.connect("host1", 1, 5, False, True)
+
+    assert mock_run.call_args[0][0][-2:] == ["host1", "true"]
+    assert connection.host == "host1"
+    assert "-tt" not in connection.args
+
+
+@mock.patch.object(openssh.subprocess, 'run', autospec=True)
+def test_connect_fails(mock_run):
+    mock_run.return_value = subprocess.CompletedProcess([], 255, b"", b"refused")
+
+    with pytest.raises(MaxConnectionAttemptsError):
+        openssh.connect("host1", 1, 5, False, False)
+
+
+@mock.patch.object(openssh.subprocess, 'Popen')
+def test_exec_command(mock_popen):
+    process = mock_popen.return_value
+    process.communicate.return_value = (b"output\n", b"")
+    process.returncode = 0
+    connection = OpenSSHConnection("host1", 5, False, False)
+
+    _, stdout, _ = connection.exec_command("my command")
+
+    assert mock_popen.call_args[0][0] == connection.args + ["my command"]
+    assert stdout.read() == b"output\n"
+
+
+@mock.patch.object(openssh.subprocess, 'Popen')
+def test_exec_command_checks_status(mock_popen):
+    process = mock_popen.return_value
+    process.communicate.return_value = (b"", b"")
+    process.returncode = 1
+    connection = OpenSSHConnection("host1", 5, False, False)
+
+    with pytest.raises(RuntimeError):
+        connection.exec_command("false")
+
+
+@mock.patch.object(openssh.subprocess, 'Popen')
+def test_sudo_command_with_password(mock_popen):
+    process = mock_popen.return_value
+    connection = OpenSSHConnection("host1", 5, False, True)
+
+    _, stdout, _ = connection.sudo_command("service kafka stop", check_status=False, passwd="secret")
+
+    assert mock_popen.call_args[0][0][-1] == "sudo -k -S -p '' service kafka stop"
+    process.stdin.write.assert_called_once_with(b"secret\n")
+    assert stdout is process.stdout
+
+
+@mock.patch.object(openssh.subprocess, 'Popen')
+def test_sudo_command_with_password_on_pty(mock_popen):
+    connection = OpenSSHConnection("host1", 5, False, True, require_pty=True)
+
+    with pytest.raises(ValueError):
+        connection.sudo_command("service kafka stop", passwd="secret")
+
+    assert not mock_popen.called
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(openssh, 'connect', autospec=True)
+def test_ssh_selects_openssh_backend(mock_connect, mock_lookup):
+    with ssh.ssh("host1", backend="openssh") as connection:
+        assert connection is mock_connect.return_value
+
+    mock_connect.assert_called_once_with("host1", 1, 5, False, False, False, True)
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(openssh, 'connect', autospec=True)
+def test_ssh_openssh_backend_rejects_password(mock_connect, mock_lookup):
+    with pytest.raises(ValueError):
+        with ssh.ssh("host1", backend="openssh", ssh_password="secret"):
+            pass
+
+    assert not mock_connect.called
+
+
+def test_wait_for_command_reads_both_streams(capfdbinary):
+    connection = OpenSSHConnection("host1", 5, False, False)
+    # run the command locally, the stderr it writes is larger than a pipe
+    connection.args = ["sh", "-c"]
+    _, stdout, stderr = connection.exec_command("head -c 300000 /dev/zero >&2; echo done; exit 3", check_status=False)
+
+    assert connection.wait_for_command("host1", stdout, stderr, report=False) == 3
+    assert capfdbinary.readouterr() == (b"", b"")
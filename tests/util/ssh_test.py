@@ -0,0 +1,703 @@
+# Copyright 2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import socket
+import tarfile
+from unittest import mock
+
+import pytest
+
+from kafka_utils.util import ssh
+from kafka_utils.util.error import MaxConnectionAttemptsError
+from kafka_utils.util.ssh import Connection
+from kafka_utils.util.ssh import PersistentShell
+from kafka_utils.util.ssh import SSHConnectionPool
+
+
+CFG = {"hostname": "host1", "timeout": 5}
+
+# the config ssh() builds for host1 with the default arguments
+SSH_CFG = {"hostname": "host1", "timeout": 5, "banner_timeout": 5, "auth_timeout": 30, "compress": True}
+
+
+def mock_client(active=True):
+    client = mock.Mock()
+    client.get_transport.return_value.is_active.return_value = active
+    return client
+
+
+class FakeShellChannel:
+    """Returns the given output, in small chunks, to every command sent."""
+
+    def __init__(self, stdout, stderr, closed=False):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.closed = closed
+        self.eof_received = False
+        self.sent = []
+        self.pending_stdout = b""
+        self.pending_stderr = b""
+
+    def sendall(self, data):
+        self.sent.append(data)
+        if not self.closed:
+            self.pending_stdout += self.stdout
+            self.pending_stderr += self.stderr
+
+    def recv_ready(self):
+        return bool(self.pending_stdout)
+
+    def recv_stderr_ready(self):
+        return bool(self.pending_stderr)
+
+    def recv(self, nbytes):
+        data, self.pending_stdout = self.pending_stdout[:3], self.pending_stdout[3:]
+        return data
+
+    def recv_stderr(self, nbytes):
+        data, self.pending_stderr = self.pending_stderr[:3], self.pending_stderr[3:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class TestPersistentShell:
+
+    def test_run(self):
+        channel = FakeShellChannel(
+            b"hello\n\n__RC=2 __KU_END__\n",
+            b"oops\n\n__KU_END__\n",
+        )
+        shell = PersistentShell(channel)
+
+        assert shell.run("my command") == (b"hello\n", b"oops\n", 2)
+        assert shell.run("my command") == (b"hello\n", b"oops\n", 2)
+        assert len(channel.sent) == 2
+        assert channel.sent[0].startswith(b"{ my command\n} </dev/null\n")
+
+    def test_run_no_output(self):
+        channel = FakeShellChannel(b"\n__RC=0 __KU_END__\n", b"\n__KU_END__\n")
+
+        assert PersistentShell(channel).run("true") == (b"", b"", 0)
+
+    @mock.patch.object(ssh.select, 'select', return_value=([], [], []), autospec=True)
+    def test_run_timeout(self, mock_select):
+        # an unbalanced quote swallows the end markers
+        channel = FakeShellChannel(b"foo\n", b"")
+
+        with pytest.raises(socket.timeout):
+            PersistentShell(channel).run("echo 'foo", timeout=0.01)
+
+    def test_run_closed_shell(self):
+        channel = FakeShellChannel(b"", b"", closed=True)
+
+        with pytest.raises(ssh.SSHException):
+            PersistentShell(channel).run("true")
+
+    def test_context_manager_closes_channel(self):
+        channel = FakeShellChannel(b"", b"")
+
+        with PersistentShell(channel):
+            pass
+
+        assert channel.closed
+
+
+class TestConnection:
+
+    def test_init_sets_keepalive_and_nodelay(self):
+        client = mock_client()
+        transport = client.get_transport.return_value
+        transport.sock = mock.Mock(spec=socket.socket)
+
+        Connection(client, False, False, keepalive_interval=10)
+
+        transport.set_keepalive.assert_called_once_with(10)
+        transport.sock.setsockopt.assert_called_once_with(
+            socket.IPPROTO_TCP,
+            socket.TCP_NODELAY,
+            1,
+        )
+
+    def test_init_skips_nodelay_on_proxy_command(self):
+        client = mock_client()
+        transport = client.get_transport.return_value
+        transport.sock = mock.Mock(spec=ssh.ProxyCommand)
+
+        # a ProxyCommand has no setsockopt, calling it would raise
+        Connection(client, False, False)
+
+        transport.set_keepalive.assert_called_once_with(30)
+
+    def test_exec_command_checks_status(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv_exit_status.return_value = 1
+        connection = Connection(client, False, False)
+
+        with pytest.raises(RuntimeError):
+            connection.exec_command("false")
+
+    def test_exec_command_does_not_wait_without_check_status(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        connection = Connection(client, False, False)
+
+        _, stdout, _ = connection.exec_command("sleep 10", check_status=False)
+
+        assert stdout is channel.makefile.return_value
+        assert not channel.recv_exit_status.called
+
+    def test_sudo_command(self):
+        connection = Connection(mock_client(), False, True)
+        with mock.patch.object(connection, 'exec_command', autospec=True) as mock_exec:
+            connection.sudo_command("service kafka stop")
+
+        mock_exec.assert_called_once_with("sudo -n service kafka stop", -1, True, pty=False)
+
+    def test_sudo_command_with_password(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv_exit_status.return_value = 0
+        connection = Connection(client, False, False)
+
+        connection.sudo_command("service kafka stop", passwd="secret")
+
+        channel.exec_command.assert_called_once_with("sudo -k -S -p '' service kafka stop")
+        channel.makefile.return_value.write.assert_called_once_with("secret\n")
+
+    def test_sudo_command_with_password_and_pty(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = [b"[sudo] pass", b"word for kafka: "]
+        channel.recv_exit_status.return_value = 0
+        connection = Connection(client, False, True, require_pty=True)
+
+        connection.sudo_command("service kafka stop", passwd="secret")
+
+        channel.exec_command.assert_called_once_with("sudo -k service kafka stop")
+        channel.send.assert_called_once_with(b"secret\n")
+        assert not channel.makefile.return_value.write.called
+
+    @pytest.mark.parametrize('recv, output', [
+        ([b"stop", b"ped\n", b""], b"stopped\n"),
+        ([b"stop", socket.timeout(), b"ped\n", b""], b"stopped\n"),
+        (
+            [b"ssl.key.password = null\n[2024-01-01 10:00:00", b"] INFO stopped\n", b""],
+            b"ssl.key.password = null\n[2024-01-01 10:00:00] INFO stopped\n",
+        ),
+    ])
+    def test_sudo_command_without_prompt(self, recv, output):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = recv
+        channel.recv_exit_status.return_value = 0
+        connection = Connection(client, False, True)
+
+        _, stdout, _ = connection.sudo_command("service kafka stop", passwd="secret", pty=True)
+
+        assert stdout.read() == output
+        assert not channel.send.called
+        assert channel.settimeout.mock_calls[-1] == mock.call(None)
+
+    def test_sudo_command_fails_without_prompt(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = [b"not found\n", b""]
+        channel.recv_exit_status.return_value = 1
+        connection = Connection(client, False, True)
+
+        with pytest.raises(ssh.SSHException):
+            connection.sudo_command("service kafka stop", passwd="secret", pty=True)
+
+        assert not channel.send.called
+
+    @pytest.mark.parametrize('independent, command', [
+        (False, "cmd1 && cmd2"),
+        (True, "cmd1; cmd2"),
+    ])
+    def test_exec_batch(self, independent, command):
+        connection = Connection(mock_client(), False, False)
+        with mock.patch.object(connection, 'exec_command', autospec=True) as mock_exec:
+            connection.exec_batch(["cmd1", "cmd2"], independent=independent)
+
+        mock_exec.assert_called_once_with(command, -1, True)
+
+    def test_wait_for_command(self, capsysbinary):
+        channel = FakeExecChannel(b"line 1\nline 2\n", b"error\n", 3)
+        connection = Connection(mock_client(), False, False)
+
+        status = connection.wait_for_command("host1", ssh.ChannelFile(channel, "rb"), ssh.ChannelStderrFile(channel, "rb"))
+
+        assert status == 3
+        out, err = capsysbinary.readouterr()
+        assert out == b"STDOUT from host1:\nline 1\nline 2\nSTDERR from host1:\n"
+        assert err == b"error\n"
+
+    def test_wait_for_command_without_report(self, capsysbinary):
+        channel = FakeExecChannel(b"line 1\n", b"error\n", 0)
+        connection = Connection(mock_client(), False, False)
+
+        status = connection.wait_for_command("host1", ssh.ChannelFile(channel, "rb"), ssh.ChannelStderrFile(channel, "rb"), report=False)
+
+        assert status == 0
+        assert not (channel.stdout or channel.stderr)
+        assert capsysbinary.readouterr() == (b"", b"")
+
+    def test_exec_command_async(self):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        connection = Connection(client, True, True)
+
+        assert connection.exec_command_async("sleep 10") is channel
+
+        assert not channel.get_pty.called
+        channel.exec_command.assert_called_once_with("sleep 10")
+        assert not channel.recv_exit_status.called
+
+    @pytest.mark.parametrize('require_pty, pty, expected', [
+        (False, None, False),
+        (True, None, True),
+        (False, True, True),
+        (True, False, False),
+    ])
+    def test_exec_command_async_pty(self, require_pty, pty, expected):
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        connection = Connection(client, False, True, require_pty=require_pty)
+
+        connection.exec_command_async("sleep 10", pty=pty)
+
+        assert channel.get_pty.called == expected
+
+    @mock.patch.object(ssh.SFTPClient, 'from_transport', autospec=True)
+    def test_put_files_reuses_sftp_session(self, mock_from_transport):
+        client = mock_client()
+        connection = Connection(client, False, False)
+
+        connection.put_file("local1", "remote1")
+        connection.put_files([("local2", "remote2"), ("local3", "remote3")])
+
+        mock_from_transport.assert_called_once_with(client.get_transport.return_value)
+        sftp = mock_from_transport.return_value
+        assert sftp.put.mock_calls == [
+            mock.call("local1", "remote1"),
+            mock.call("local2", "remote2"),
+            mock.call("local3", "remote3"),
+        ]
+
+        connection.close_sftp()
+        sftp.close.assert_called_once_with()
+
+    def test_put_archive(self, tmpdir):
+        local_paths = []
+        for name in ("server.properties", "log4j.properties"):
+            path = tmpdir.join(name)
+            path.write(name)
+            local_paths.append(str(path))
+        client = mock_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv_exit_status.return_value = 0
+        stream = io.BytesIO()
+        channel.makefile.return_value = mock.MagicMock()
+        channel.makefile.return_value.__enter__.return_value.write.side_effect = stream.write
+        connection = Connection(client, False, True)
+
+        connection.put_archive(local_paths, "/etc/kafka dir")
+
+        channel.exec_command.assert_called_once_with("tar xf - -C '/etc/kafka dir'")
+        assert not channel.get_pty.called
+        channel.shutdown_write.assert_called_once_with()
+        channel.close.assert_called_once_with()
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as archive:
+            assert archive.getnames() == ["server.properties", "log4j.properties"]
+            assert archive.extractfile("log4j.properties").read() == b"log4j.properties"
+
+    def test_open_persistent_shell(self):
+        client = mock_client()
+        connection = Connection(client, False, False)
+
+        shell = connection.open_persistent_shell()
+
+        channel = client.get_transport.return_value.open_session.return_value
+        assert shell.channel is channel
+        channel.invoke_shell.assert_called_once_with()
+        assert not channel.get_pty.called
+
+
+class TestSSHConnectionPool:
+
+    @pytest.fixture
+    def mock_connect(self):
+        with mock.patch.object(ssh, '_connect', autospec=True) as mock_connect:
+            mock_connect.side_effect = lambda *args, **kwargs: mock_client()
+            yield mock_connect
+
+    def test_borrow_connects_when_empty(self, mock_connect):
+        pool = SSHConnectionPool()
+
+        client = pool.borrow("host1", CFG, 3, 2)
+
+        assert client is not None
+        mock_connect.assert_called_once_with("host1", CFG, 3, 2, None)
+
+    def test_borrow_reuses_released_client(self, mock_connect):
+        pool = SSHConnectionPool()
+        client = pool.borrow("host1", CFG)
+
+        pool.release("host1", CFG, client)
+
+        assert pool.borrow("host1", CFG) is client
+        assert mock_connect.call_count == 1
+
+    @pytest.mark.parametrize('option', [
+        {"username": "other"},
+        {"compress": False},
+        {"disabled_algorithms": {"pubkeys": ["rsa-sha2-512", "rsa-sha2-256"]}},
+        {"password": "secret"},
+    ])
+    def test_borrow_does_not_share_between_keys(self, mock_connect, option):
+        pool = SSHConnectionPool()
+        client = pool.borrow("host1", dict(CFG, compress=True))
+        pool.release("host1", dict(CFG, compress=True), client)
+
+        other = pool.borrow("host1", {**CFG, "compress": True, **option})
+
+        assert other is not client
+        assert mock_connect.call_count == 2
+
+    def test_borrow_shares_between_timeouts(self, mock_connect):
+        pool = SSHConnectionPool()
+        client = pool.borrow("host1", CFG)
+        pool.release("host1", CFG, client)
+
+        assert pool.borrow("host1", dict(CFG, timeout=10, banner_timeout=10)) is client
+
+    def test_release_closes_dead_client(self, mock_connect):
+        pool = SSHConnectionPool()
+        client = mock_client(active=False)
+
+        pool.release("host1", CFG, client)
+
+        client.close.assert_called_once_with()
+        pool.borrow("host1", CFG)
+        assert mock_connect.call_count == 1
+
+    def test_release_closes_above_max_per_host(self, mock_connect):
+        pool = SSHConnectionPool(max_per_host=1)
+        first, second = mock_client(), mock_client()
+
+        pool.release("host1", CFG, first)
+        pool.release("host1", CFG, second)
+
+        assert not first.close.called
+        second.close.assert_called_once_with()
+
+    def test_borrow_discards_expired_client(self, mock_connect):
+        pool = SSHConnectionPool(max_idle=0)
+        client = mock_client()
+        with mock.patch.object(ssh.time, 'monotonic', side_effect=[0, 10]):
+            pool.release("host1", CFG, client)
+            assert pool.borrow("host1", CFG) is not client
+        client.close.assert_called_once_with()
+
+    def test_close(self, mock_connect):
+        pool = SSHConnectionPool()
+        client = mock_client()
+        pool.release("host1", CFG, client)
+
+        pool.close()
+
+        client.close.assert_called_once_with()
+
+
+@mock.patch.object(ssh.os.path, 'exists', return_value=True, autospec=True)
+@mock.patch.object(
+    ssh,
+    'open',
+    mock.mock_open(read_data="Host host1\n  User kafka\n  Port 2222\n"),
+    create=True,
+)
+def test_lookup_host_config_parses_once(mock_exists):
+    ssh._load_ssh_config.cache_clear()
+    ssh._lookup_host_config.cache_clear()
+    try:
+        host_config = ssh._lookup_host_config("host1")
+        ssh._lookup_host_config("host2")
+
+        assert host_config["user"] == "kafka"
+        assert host_config["port"] == "2222"
+        assert mock_exists.call_count == 1
+    finally:
+        ssh._load_ssh_config.cache_clear()
+        ssh._lookup_host_config.cache_clear()
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(ssh, 'connection_pool', autospec=True)
+def test_ssh_releases_client_to_pool(mock_pool, mock_lookup):
+    with ssh.ssh("host1") as connection:
+        assert connection.client is mock_pool.borrow.return_value
+
+    mock_pool.release.assert_called_once_with(
+        "host1",
+        SSH_CFG,
+        mock_pool.borrow.return_value,
+    )
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(ssh, 'connection_pool', autospec=True)
+def test_ssh_closes_client_on_error(mock_pool, mock_lookup):
+    with pytest.raises(RuntimeError):
+        with ssh.ssh("host1"):
+            raise RuntimeError()
+
+    mock_pool.borrow.return_value.close.assert_called_once_with()
+    assert not mock_pool.release.called
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(ssh, '_connect', autospec=True)
+@mock.patch.object(ssh, 'connection_pool', autospec=True)
+def test_ssh_not_pooled(mock_pool, mock_connect, mock_lookup):
+    with ssh.ssh("host1", pooled=False) as connection:
+        assert connection.client is mock_connect.return_value
+
+    mock_connect.return_value.close.assert_called_once_with()
+    assert not mock_pool.borrow.called
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(ssh, 'connection_pool', autospec=True)
+def test_ssh_without_compression(mock_pool, mock_lookup):
+    with ssh.ssh("host1", compress=False):
+        pass
+
+    assert mock_pool.borrow.call_args[0][1]["compress"] is False
+
+
+class FakeExecChannel:
+    """Delivers its output a few bytes at a time, then its exit status."""
+
+    def __init__(self, stdout, stderr, status):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.status = status
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv(self, nbytes):
+        data, self.stdout = self.stdout[:3], self.stdout[3:]
+        return data
+
+    def recv_stderr(self, nbytes):
+        data, self.stderr = self.stderr[:3], self.stderr[3:]
+        return data
+
+    def exit_status_ready(self):
+        return not (self.stdout or self.stderr)
+
+    def recv_exit_status(self):
+        return self.status
+
+
+@mock.patch.object(ssh.select, 'select', side_effect=lambda r, w, x, timeout: (r, w, x), autospec=True)
+def test_wait_for_channels(mock_select):
+    channels = [
+        FakeExecChannel(b"slow output", b"", 0),
+        FakeExecChannel(b"ok", b"error", 1),
+    ]
+
+    assert ssh.wait_for_channels(channels) == [
+        (b"slow output", b"", 0),
+        (b"ok", b"error", 1),
+    ]
+
+
+@mock.patch.object(ssh.select, 'select', return_value=([], [], []), autospec=True)
+def test_wait_for_channels_timeout(mock_select):
+    with pytest.raises(socket.timeout):
+        ssh.wait_for_channels([FakeExecChannel(b"", b"", 0)], timeout=0)
+
+
+class FakeChannelFile:
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def test_report_stdout(capsysbinary):
+    ssh.report_stdout("host1", FakeChannelFile([b"line 1\r\nli", b"ne 2\nline 3"]))
+
+    out, err = capsysbinary.readouterr()
+    assert out == b"STDOUT from host1:\nline 1\nline 2\nline 3\n"
+    assert err == b""
+
+
+@pytest.mark.parametrize('file_class, recv', [
+    (ssh.ChannelFile, 'recv'),
+    (ssh.ChannelStderrFile, 'recv_stderr'),
+])
+def test_report_lines_does_not_wait_for_full_chunks(file_class, recv):
+    channel = mock.Mock()
+    getattr(channel, recv).side_effect = [b"line 1\n", b"line 2\n", b""]
+    output = mock.Mock()
+
+    ssh._report_lines(ssh.LineReporter("", output), file_class(channel, "rb"))
+
+    getattr(channel, recv).assert_called_with(ssh.REPORT_CHUNK_SIZE)
+    assert output.write.mock_calls == [mock.call(b"line 1\n"), mock.call(b"line 2\n")]
+
+
+def test_report_lines_writes_once_per_chunk():
+    output = mock.Mock()
+
+    ssh._report_lines(ssh.LineReporter("", output), FakeChannelFile([b"line 1\nline 2\nli", b"ne 3\n"]))
+
+    assert output.write.mock_calls == [
+        mock.call(b"line 1\nline 2\n"),
+        mock.call(b"line 3\n"),
+    ]
+    # flushed with every write, so that the lines show up as they arrive
+    assert output.flush.call_count == 2
+
+
+def test_report_stdout_no_output(capsysbinary):
+    ssh.report_stdout("host1", FakeChannelFile([]))
+
+    assert capsysbinary.readouterr() == (b"", b"")
+
+
+def test_report_stderr(capsysbinary):
+    ssh.report_stderr("host1", FakeChannelFile([b"error\n"]))
+
+    out, err = capsysbinary.readouterr()
+    assert out == b"STDERR from host1:\n"
+    assert err == b"error\n"
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+@mock.patch.object(ssh, 'connection_pool', autospec=True)
+def test_ssh_disabled_algorithms(mock_pool, mock_lookup):
+    disabled = {"pubkeys": ["rsa-sha2-512", "rsa-sha2-256"]}
+    with ssh.ssh("host1", disabled_algorithms=disabled):
+        pass
+
+    cfg = mock_pool.borrow.call_args[0][1]
+    assert cfg["disabled_algorithms"] == disabled
+
+
+@mock.patch.object(ssh.random, 'uniform', return_value=0.1, autospec=True)
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+def test_retry_connect_backs_off(mock_sleep, mock_uniform):
+    connect = mock.Mock(side_effect=[OSError(), OSError(), OSError(), "connected"])
+
+    assert ssh.retry_connect("host1", connect, 4, 1) == "connected"
+
+    assert mock_sleep.mock_calls == [mock.call(0.6), mock.call(1), mock.call(1)]
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+def test_retry_connect_max_attempts(mock_sleep):
+    connect = mock.Mock(side_effect=OSError())
+
+    with pytest.raises(MaxConnectionAttemptsError):
+        ssh.retry_connect("host1", connect, 3, 5)
+
+    assert connect.call_count == 3
+    assert mock_sleep.call_count == 2
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+def test_retry_connect_retries_ssh_exceptions(mock_sleep):
+    connect = mock.Mock(side_effect=[ssh.SSHException("Error reading SSH protocol banner"), "connected"])
+
+    assert ssh.retry_connect("host1", connect, 2, 5) == "connected"
+
+    assert connect.call_count == 2
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+def test_retry_connect_max_attempts_on_ssh_exceptions(mock_sleep):
+    connect = mock.Mock(side_effect=ssh.SSHException("Error reading SSH protocol banner"))
+
+    with pytest.raises(MaxConnectionAttemptsError):
+        ssh.retry_connect("host1", connect, 3, 5)
+
+    assert connect.call_count == 3
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+def test_retry_connect_does_not_retry_authentication_failures(mock_sleep):
+    connect = mock.Mock(side_effect=ssh.AuthenticationException("Authentication failed."))
+
+    with pytest.raises(ssh.AuthenticationException):
+        ssh.retry_connect("host1", connect, 3, 5)
+
+    assert connect.call_count == 1
+    assert not mock_sleep.called
+
+
+@mock.patch.object(ssh.time, 'sleep', autospec=True)
+@mock.patch.object(ssh, 'ProxyCommand', autospec=True)
+@mock.patch.object(ssh, 'SSHClient', autospec=True)
+def test_connect_uses_a_fresh_client_per_attempt(mock_client_class, mock_proxy, mock_sleep):
+    failed, connected = mock.Mock(), mock.Mock()
+    failed.connect.side_effect = OSError()
+    mock_client_class.side_effect = [failed, connected]
+    failed_proxy, proxy = mock.Mock(), mock.Mock()
+    mock_proxy.side_effect = [failed_proxy, proxy]
+
+    assert ssh._connect("host1", CFG, 2, 5, "ssh -W %h:%p bastion") is connected
+
+    failed.close.assert_called_once_with()
+    failed_proxy.close.assert_called_once_with()
+    connected.connect.assert_called_once_with(sock=proxy, **CFG)
+    assert not connected.close.called
+
+
+@mock.patch.object(ssh, 'SSHClient', autospec=True)
+def test_connect_does_not_load_known_hosts(mock_client_class):
+    client = mock_client_class.return_value
+
+    assert ssh._connect("host1", CFG, 1, 5) is client
+
+    assert not client.load_system_host_keys.called
+    assert not client.load_host_keys.called
+    client.set_missing_host_key_policy.assert_called_once_with(mock.ANY)
+    assert isinstance(client.set_missing_host_key_policy.call_args[0][0], ssh.AutoAddPolicy)
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1', 'proxycommand': 'ssh -W %h:%p bastion'}, autospec=True)
+def test_ssh_ssh2_backend_rejects_proxy_command(mock_lookup):
+    with pytest.raises(ValueError):
+        with ssh.ssh("host1", backend="ssh2"):
+            pass
+
+
+@mock.patch.object(ssh, '_lookup_host_config', return_value={'hostname': 'host1'}, autospec=True)
+def test_ssh_unknown_backend(mock_lookup):
+    with pytest.raises(ValueError):
+        with ssh.ssh("host1", backend="unknown"):
+            pass